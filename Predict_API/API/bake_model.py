@@ -0,0 +1,39 @@
+import argparse
+import os
+import shutil
+
+
+#### Copy of a model of the MLflow server into a local directory, to be baked into the image of the
+#### API (see Dockerfile.serving): with MODEL_PATH set to that directory, the API loads its model
+#### without contacting the tracking server nor downloading anything at startup.
+####   python bake_model.py --model-path runs:/<run_id>/Getaround_PredictPricing_onnx --output model
+
+def bake(model_path, output, tracking_uri=None):
+    """Download the artifacts of `model_path` (an MLflow URI) into the directory `output`, replaced if it exists."""
+    import mlflow
+    if tracking_uri:
+        mlflow.set_tracking_uri(tracking_uri)
+    staging = output.rstrip('/') + '.tmp'
+    shutil.rmtree(staging, ignore_errors=True)
+    os.makedirs(staging)
+    mlflow.artifacts.download_artifacts(model_path, dst_path=staging)
+    # download_artifacts puts the files in a subdirectory named like the artifact
+    downloaded = os.listdir(staging)
+    source = os.path.join(staging, downloaded[0]) if len(downloaded) == 1 and \
+        os.path.isdir(os.path.join(staging, downloaded[0])) else staging
+    shutil.rmtree(output, ignore_errors=True)
+    shutil.move(source, output)
+    shutil.rmtree(staging, ignore_errors=True)
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-path", default=os.environ.get('MODEL_PATH'),
+                        help="model to bake, e.g. runs:/<run_id>/Getaround_PredictPricing_onnx (MODEL_PATH by default)")
+    parser.add_argument("--tracking-uri", default=os.environ.get('MLOPS_SERVER_URI'))
+    parser.add_argument("--output", default="model", help="local directory of the model")
+    args = parser.parse_args()
+    if not args.model_path:
+        parser.error("--model-path or MODEL_PATH is required")
+    print(f"{args.model_path} baked into {bake(args.model_path, args.output, args.tracking_uri)}")
@@ -0,0 +1,245 @@
+import argparse
+import json
+import os
+import re
+import resource
+import socket
+import sys
+import tempfile
+import threading
+import time
+import requests
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+sys.path.insert(0, SRC_PATH)
+ML_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ml')
+
+DATA_URL = 'https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv'
+
+
+#### Benchmark of the API run in-process against a local model: latency of /predict alone and under
+#### concurrency, throughput of the batch endpoints, and memory. Results can be saved with --output
+#### and compared to a previous run with --baseline, e.g. before a deploy:
+####   python bench.py --data pricing.csv --output before.json
+####   python bench.py --data pricing.csv --baseline before.json
+
+def load_cars(data):
+    pricing = pd.read_csv(data)
+    pricing = pricing.drop(columns=[col for col in ('Unnamed: 0', 'rental_price_per_day') if col in pricing.columns])
+    return pricing.astype({'mileage': float, 'engine_power': float})
+
+
+def train_fixture_model(data, tracking_uri):
+    """Pipeline of train.py (AllCats preprocessing, XGBRegressor) fitted on `data` and logged to `tracking_uri`."""
+    import mlflow
+    from mlflow.models.signature import infer_signature
+    from sklearn.pipeline import Pipeline
+    from xgboost import XGBRegressor
+    # Steps built by train.py itself, which needs a tracking URI when imported
+    os.environ.setdefault('MLFLOW_TRACKING_URI', tracking_uri)
+    sys.path.insert(0, ML_PATH)
+    from train import make_steps, make_preprocessor, TARGET, FEATURES_PATH
+
+    pricing = pd.read_csv(data).drop(columns='Unnamed: 0', errors='ignore')
+    X = pricing.drop(columns=TARGET).astype({'mileage': float, 'engine_power': float})
+    cleaner, mapper = make_steps('AllCats')
+    model = Pipeline(steps=[
+        ("Cleaning", cleaner),
+        ("Mapping", mapper),
+        ("Preprocessing", make_preprocessor(list(X.columns))),
+        ("Regressor", XGBRegressor(max_depth=4, min_child_weight=10, n_estimators=125)),
+    ])
+    model.fit(X, pricing[TARGET])
+
+    mlflow.set_tracking_uri(tracking_uri)
+    mlflow.set_experiment("Getaround_PredictPricing_bench")
+    with mlflow.start_run() as run:
+        mlflow.sklearn.log_model(sk_model=model, artifact_path="Getaround_PredictPricing",
+                                 signature=infer_signature(X, model.predict(X)),
+                                 code_paths=[FEATURES_PATH])
+    return f"runs:/{run.info.run_id}/Getaround_PredictPricing"
+
+
+def rss_mb():
+    """Resident memory of this process (the API included), in MB."""
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+def start_api(timeout=120):
+    """Serve app.py with uvicorn in a thread of this process, returns the server, its thread and its url."""
+    import uvicorn
+    import app
+
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(app.app, host='127.0.0.1', port=port, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    url = f'http://127.0.0.1:{port}'
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            response = requests.get(url + '/ready')
+            if response.status_code == 200:
+                return server, thread, url
+            if response.json().get('error'):
+                raise RuntimeError(f"model loading failed: {response.json()['error']}")
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError(f"API not ready after {timeout}s")
+
+
+def summary(latencies):
+    latencies = np.array(latencies) * 1000
+    return {'p50_ms': float(np.percentile(latencies, 50)), 'p95_ms': float(np.percentile(latencies, 95)),
+            'p99_ms': float(np.percentile(latencies, 99)), 'max_ms': float(latencies.max())}
+
+
+def bench_single(url, cars, requests_number):
+    """Latency of /predict, one request at a time."""
+    session = requests.Session()
+    latencies = []
+    for car in cars[:requests_number]:
+        start = time.perf_counter()
+        session.post(url + '/predict', json=car).raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return summary(latencies)
+
+
+def bench_concurrency(url, cars, concurrency, requests_number):
+    """Latency and throughput of /predict with `concurrency` clients."""
+    sessions = threading.local()
+    def timed_request(car):
+        if not hasattr(sessions, 'session'):
+            sessions.session = requests.Session()
+        start = time.perf_counter()
+        status = sessions.session.post(url + '/predict', json=car).status_code
+        return time.perf_counter() - start, status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(timed_request, cars[:requests_number]))
+    total = time.perf_counter() - start
+    latencies = [latency for latency, status in results if status == 200]
+    return dict(summary(latencies), requests_per_second=len(results) / total, errors=len(results) - len(latencies))
+
+
+def bench_batch(url, cars, batch_size, repeat):
+    """Throughput of /predict/batch (JSON list) and /predict/batch/file (Parquet upload), in cars per second."""
+    session = requests.Session()
+    records = cars[:batch_size]
+    with tempfile.TemporaryFile() as f:
+        pd.DataFrame(records).to_parquet(f)
+        f.seek(0)
+        parquet = f.read()
+    results = {}
+    for endpoint in ('batch', 'file'):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            if endpoint == 'batch':
+                response = session.post(url + '/predict/batch', json=records)
+            else:
+                response = session.post(url + '/predict/batch/file', files={'file': ('cars.parquet', parquet)})
+            response.raise_for_status()
+        results[endpoint + '_cars_per_second'] = repeat * len(records) / (time.perf_counter() - start)
+    return results
+
+
+def stage_means(url):
+    """Mean time of each stage of the predictions, from the /metrics of the API (ms)."""
+    metrics = requests.get(url + '/metrics').text
+    sums = dict(re.findall(r'getaround_stage_seconds_sum\{stage="(\w+)"\} (\S+)', metrics))
+    counts = dict(re.findall(r'getaround_stage_seconds_count\{stage="(\w+)"\} (\S+)', metrics))
+    return {stage: float(sums[stage]) / float(counts[stage]) * 1000 for stage in sums if float(counts[stage])}
+
+
+def compare(results, baseline, tolerance):
+    """Regressions of more than `tolerance` (relative) against a previous run, as messages."""
+    regressions = []
+    for section, values in results.items():
+        for name, value in values.items():
+            previous = baseline.get(section, {}).get(name)
+            if not previous or not (name.endswith('_ms') or name.endswith('per_second')):
+                continue
+            higher_is_better = name.endswith('per_second')
+            change = (value - previous) / previous
+            if (higher_is_better and change < -tolerance) or (name.endswith('_ms') and change > tolerance):
+                regressions.append(f'{section} {name}: {previous:.2f} -> {value:.2f} ({change:+.0%})')
+    return regressions
+
+
+def run(args):
+    if args.model_path is None:
+        print('training fixture model...')
+        os.environ['MODEL_PATH'] = train_fixture_model(args.data, args.tracking_uri)
+    else:
+        os.environ['MODEL_PATH'] = args.model_path
+    os.environ['MLOPS_SERVER_URI'] = args.tracking_uri
+    for option in args.env:
+        name, value = option.split('=', 1)
+        os.environ[name] = value
+
+    cars = load_cars(args.data).sample(frac=1, random_state=0)
+    # As many different cars as requests, so that a prediction cache does not hide the model latency
+    cars = pd.concat([cars] * (max(args.requests, max(args.batch_sizes)) // len(cars) + 1), ignore_index=True)
+    cars['mileage'] = cars['mileage'] + np.arange(len(cars)) % 1000
+    cars = cars.to_dict(orient='records')
+
+    results = {'memory': {'rss_before_api_mb': rss_mb()}}
+    start = time.perf_counter()
+    server, thread, url = start_api()
+    results['startup'] = {'ready_seconds': time.perf_counter() - start}
+    results['memory']['rss_model_loaded_mb'] = rss_mb()
+    try:
+        results['single'] = bench_single(url, cars, min(args.requests, 200))
+        for concurrency in args.concurrency:
+            results[f'concurrency_{concurrency}'] = bench_concurrency(url, cars, concurrency, args.requests)
+        for batch_size in args.batch_sizes:
+            results[f'batch_{batch_size}'] = bench_batch(url, cars, batch_size, args.batch_repeat)
+        results['stages_mean_ms'] = stage_means(url)
+    finally:
+        server.should_exit = True
+        thread.join()
+    results['memory'].update(rss_after_mb=rss_mb(), peak_rss_mb=peak_rss_mb())
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--data", default=DATA_URL, help="CSV of cars, the pricing dataset by default")
+    parser.add_argument("--model-path", help="model to serve (e.g. runs:/<run_id>/Getaround_PredictPricing), "
+                                             "by default a model is trained on --data and logged to --tracking-uri")
+    parser.add_argument("--tracking-uri", default="file:" + os.path.abspath("mlruns"))
+    parser.add_argument("--env", nargs="*", default=[], help="options of the API, e.g. FAST_INFERENCE=true")
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--batch-repeat", type=int, default=5)
+    parser.add_argument("--output", help="save the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run: exit with an error on regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+    for section, values in results.items():
+        print(section + ': ' + ', '.join(f'{name} {value:.2f}' for name, value in values.items()))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        sys.exit(1 if regressions else 0)
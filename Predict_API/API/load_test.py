@@ -0,0 +1,68 @@
+import argparse
+import threading
+import time
+import requests
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+
+
+#### Load test of a running API: latency of /predict under concurrency, while probing /ready
+
+CAR = {
+    'model_key': 'Citroën', 'mileage': 140411.0, 'engine_power': 100.0, 'fuel': 'diesel',
+    'paint_color': 'black', 'car_type': 'convertible', 'private_parking_available': True,
+    'has_gps': True, 'has_air_conditioning': False, 'automatic_car': False,
+    'has_getaround_connect': True, 'has_speed_regulator': True, 'winter_tires': True
+}
+
+
+def timed_request(session, method, url, car=None):
+    start = time.perf_counter()
+    response = session.request(method, url, json=car)
+    return (time.perf_counter() - start) * 1000, response.status_code
+
+
+def percentiles(latencies):
+    if not latencies:
+        return 'no successful request'
+    latencies = np.array(latencies)
+    return (f'p50 {np.percentile(latencies, 50):.1f}, p95 {np.percentile(latencies, 95):.1f}, '
+            f'p99 {np.percentile(latencies, 99):.1f}, max {latencies.max():.1f}')
+
+
+def load_test(url, concurrency, requests_number):
+    # Cars all different so that a prediction cache does not hide the model latency
+    cars = [dict(CAR, mileage=float(i)) for i in range(requests_number)]
+    session = requests.Session()
+
+    # Health checks during the load, they should not wait for the predictions
+    ready_latencies = []
+    loading = threading.Event()
+    def probe_ready():
+        while not loading.is_set():
+            ready_latencies.append(timed_request(session, 'GET', url + '/ready')[0])
+            time.sleep(0.1)
+    prober = threading.Thread(target=probe_ready)
+
+    start = time.perf_counter()
+    prober.start()
+    with ThreadPoolExecutor(concurrency) as executor:
+        results = list(executor.map(lambda car: timed_request(session, 'POST', url + '/predict', car), cars))
+    total = time.perf_counter() - start
+    loading.set()
+    prober.join()
+
+    latencies = [latency for latency, status in results if status == 200]
+    errors = len(results) - len(latencies)
+    print(f'{requests_number} requests, concurrency {concurrency}: {requests_number/total:.1f} req/s, {errors} errors')
+    print(f'/predict latency (ms): {percentiles(latencies)}')
+    print(f'/ready latency during the load (ms): {percentiles(ready_latencies)}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:6001")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=1000)
+    args = parser.parse_args()
+    load_test(args.url.rstrip('/'), args.concurrency, args.requests)
@@ -1,35 +1,175 @@
+import time
+# Start of the import of the API, for getaround_startup_seconds
+started_at = time.perf_counter()
+
 import os
-import uvicorn
-import mlflow 
+import io
+import json
+import asyncio
+import tempfile
 import pandas as pd 
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from typing import Literal, List, Union
-from fastapi import FastAPI, File, UploadFile, Request
-from fastapi.responses import JSONResponse
+from typing import List, Optional
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Header
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, StreamingResponse, PlainTextResponse, FileResponse
+
+from model_cache import ModelCache
+from batching import MicroBatcher
+from metrics import registry
+from instrumentation import InstrumentationMiddleware, timed_stage, record_validation, publish_model, batch_sizes, \
+    startup_seconds
+from prediction_cache import PredictionCache, InMemoryCache, RedisCache
+from executors import InferenceExecutor, default_workers, default_nthread, predict_one, predict_frame, predict_records
+from routing import ModelRouter, UnknownModel, parse_routes, MAIN_MODEL
+from jobs import JobRunner
 
 default_port = os.environ.get('DEFAULT_PORT')
 mlops_server_uri = os.environ.get('MLOPS_SERVER_URI')
 model_path = os.environ.get('MODEL_PATH')
+max_batch_size = int(os.environ.get('MAX_BATCH_SIZE', 10000))
+micro_batching = os.environ.get('MICRO_BATCHING', 'false').lower() == 'true'
+micro_batch_max_size = int(os.environ.get('MICRO_BATCH_MAX_SIZE', 64))
+micro_batch_max_wait_ms = float(os.environ.get('MICRO_BATCH_MAX_WAIT_MS', 5))
+fast_inference = os.environ.get('FAST_INFERENCE', 'false').lower() == 'true'
+prediction_cache_backend = os.environ.get('PREDICTION_CACHE', '').lower() # memory, redis or empty (no cache)
+prediction_cache_size = int(os.environ.get('PREDICTION_CACHE_SIZE', 10000))
+prediction_cache_ttl = float(os.environ.get('PREDICTION_CACHE_TTL', 3600))
+prediction_cache_redis_url = os.environ.get('PREDICTION_CACHE_REDIS_URL', 'redis://localhost:6379/0')
+inference_backend = os.environ.get('INFERENCE_BACKEND', 'thread') # thread or process
+serving_mode = os.environ.get('SERVING_MODE', 'mlflow') # mlflow or onnx
+inference_workers = int(os.environ.get('INFERENCE_WORKERS', default_workers()))
+inference_nthread = int(os.environ.get('INFERENCE_NTHREAD', default_nthread(inference_workers)))
+timing_headers = os.environ.get('TIMING_HEADERS', 'false').lower() == 'true'
+model_routes = parse_routes(os.environ.get('MODEL_ROUTES')) # other resident models and weights, see routing.py
+shadow_model = os.environ.get('SHADOW_MODEL') or None # name of a route scored in shadow
+shadow_max_pending = int(os.environ.get('SHADOW_MAX_PENDING', 100))
+jobs_dir = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'getaround_jobs'))
+job_chunk_size = int(os.environ.get('JOB_CHUNK_SIZE', 50000))
+job_workers = int(os.environ.get('JOB_WORKERS', default_workers()))
+job_retention = float(os.environ.get('JOB_RETENTION', 86400)) # seconds finished jobs and their files are kept
+job_max_finished = int(os.environ.get('JOB_MAX_FINISHED', 100))
 
 description = """
 Getaround Predict prices API helps you optimize your car's pricing based on its features. 
-It has one endpoint:
+It has one main endpoint:
 
 ## Predict 
 
 Where you can:
 * Get the price prediction according to your car's features
+* Get the price predictions of many cars at once, as a JSON list or a CSV / Parquet / JSON file
+* Choose the model serving the prediction with the `X-Model` header, when several models are served
+
+## Jobs
+
+Where you can:
+* Submit a large CSV / Parquet file of cars, scored in the background
+* Follow the progress of the job and download the file of predictions once it is done
+
+## Health
+
+Where you can:
+* Check that the prediction model is loaded and ready to serve
+* Reload the model (e.g. after a new training run) without restarting the API
+* List the models served, their share of the requests and the shadow model
+* Follow the API metrics, in the Prometheus format
 
-Check out documentation for more information on this endpoint. 
+Check out documentation for more information on these endpoints. 
 """
 
 tags_metadata = [
     {
         "name": "Predict",
         "description": "Get the price prediction according to your car's features",
+    },
+    {
+        "name": "Jobs",
+        "description": "Score a whole file of cars in the background, e.g. to reprice the whole fleet",
+    },
+    {
+        "name": "Health",
+        "description": "Readiness of the API and management of the loaded model",
     }
 ]
 
+# Car used to warm the model up before it is marked as ready
+warmup_features = {
+    'model_key': 'Citroën', 'mileage': 140411.0, 'engine_power': 100.0, 'fuel': 'diesel',
+    'paint_color': 'black', 'car_type': 'convertible', 'private_parking_available': True,
+    'has_gps': True, 'has_air_conditioning': False, 'automatic_car': False,
+    'has_getaround_connect': True, 'has_speed_regulator': True, 'winter_tires': True
+}
+
+
+if len(model_routes) > 1 and inference_backend == 'process':
+    raise ValueError("MODEL_ROUTES needs INFERENCE_BACKEND=thread: the processes of the process backend only hold the main model")
+
+warmup_input = pd.DataFrame(warmup_features, index=[0])
+model_cache = ModelCache(mlops_server_uri, model_path, warmup_input=warmup_input,
+                         fast_path=fast_inference, nthread=inference_nthread, serving_mode=serving_mode)
+model_caches = {MAIN_MODEL: model_cache}
+for name, (route_path, _) in model_routes.items():
+    if name != MAIN_MODEL:
+        model_caches[name] = ModelCache(mlops_server_uri, route_path, warmup_input=warmup_input,
+                                        fast_path=fast_inference, nthread=inference_nthread, serving_mode=serving_mode)
+router = ModelRouter(model_caches, {name: weight for name, (_, weight) in model_routes.items()},
+                     shadow_model, shadow_max_pending)
+inference = InferenceExecutor(model_cache, inference_backend, inference_workers)
+
+if prediction_cache_backend == 'memory':
+    prediction_cache = PredictionCache(InMemoryCache(prediction_cache_size, prediction_cache_ttl))
+elif prediction_cache_backend == 'redis':
+    prediction_cache = PredictionCache(RedisCache(prediction_cache_redis_url, prediction_cache_ttl))
+else:
+    prediction_cache = None
+if prediction_cache is not None:
+    for cache in model_caches.values():
+        cache.on_swap(prediction_cache.invalidate)
+
+
+def load_model_in_background():
+    # The main model first: the API is ready once it is loaded, the other routes follow
+    for name, cache in model_caches.items():
+        try:
+            entry = cache.load()
+        except Exception as e:
+            print(f'model {name} loading failed: {e}')
+            continue
+        publish_model(entry, serving_mode, name)
+        if name == MAIN_MODEL:
+            startup_seconds.set(entry.load_seconds, phase='model_load')
+            startup_seconds.set(time.perf_counter() - started_at, phase='ready')
+        print(f'model {name} ({entry.version}) loaded in {entry.load_seconds:.2f}s')
+
+
+async def predict_rows(rows):
+    """Score a list of cars (dicts of features) queued by the micro-batcher."""
+    return await inference.run(predict_records, get_current_model(), rows)
+
+
+micro_batcher = MicroBatcher(predict_rows, micro_batch_max_size, micro_batch_max_wait_ms) if micro_batching else None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # The model is loaded off the event loop so that /ready can answer while it downloads
+    loading = asyncio.get_running_loop().run_in_executor(None, load_model_in_background)
+    inference.start()
+    router.start()
+    job_runner.start()
+    if micro_batcher is not None:
+        micro_batcher.start()
+    yield
+    if micro_batcher is not None:
+        await micro_batcher.stop()
+    job_runner.shutdown()
+    router.shutdown()
+    inference.shutdown()
+    await loading
+
+
 app = FastAPI(
     title="🚗 Getaround Predict prices",
     description=description,
@@ -38,8 +178,10 @@ app = FastAPI(
         "name": "GetAround API - by Eugénie",
         "url": "https://eug-m-jedha-api.hf.space",
     },
-    openapi_tags=tags_metadata
+    openapi_tags=tags_metadata,
+    lifespan=lifespan
 )
+app.add_middleware(InstrumentationMiddleware, timing_header=timing_headers)
 
 class PredictionFeatures(BaseModel):
     model_key: str
@@ -57,8 +199,23 @@ class PredictionFeatures(BaseModel):
     winter_tires: bool
 
 
+feature_columns = list(PredictionFeatures.model_fields.keys())
+feature_dtypes = {name: field.annotation for name, field in PredictionFeatures.model_fields.items()}
+
+
+class ReloadRequest(BaseModel):
+    model_path: Optional[str] = None
+    model: str = MAIN_MODEL
+
+
+# Headers choosing the model of a request, when several are served (MODEL_ROUTES)
+ModelHeader = Header(None, description="Name of the model serving the request (see /models), drawn by weight if not given")
+RoutingKeyHeader = Header(None, description="Requests with the same key (e.g. a user id) are served by the same model")
+
+
 @app.post("/predict", tags=["Predict"])
-async def predict(predictionFeatures: PredictionFeatures):
+async def predict(predictionFeatures: PredictionFeatures, x_model: Optional[str] = ModelHeader,
+                  x_routing_key: Optional[str] = RoutingKeyHeader):
     """
     Prediction for one observation. Endpoint will return a dictionnary like this:
 
@@ -84,32 +241,299 @@ async def predict(predictionFeatures: PredictionFeatures):
     - do you have getaroung connect, as a boolean
     - does your car have a speed regulator, as a boolean
     - do you have winter tires, as a boolean
+
+    When several models are served, the name of the model that made the prediction is in the 
+    `X-Model` header of the response.
     """
-    # Read data 
-    pricing = pd.DataFrame(dict(predictionFeatures), index=[0])
-    dict_changes = {}
-    dict_changes['model_key'] = {'Fiat': 'low_price', 'Mazda': 'low_price', 'Ford': 'low_price', 'Mercedes': 'low_price',
-                                    'Porsche': 'medium_price', 'Honda': 'medium_price', 'Yamaha': 'medium_price', 
-                                    'Lamborghini': 'medium_price', 'Alfa Romeo': 'medium_price', 'KIA Motors': 'medium_price', 
-                                    'Opel': 'medium_price',
-                                    'Suzuki': 'high_price', 'Mini': 'high_price', 'Lexus': 'high_price', 'Maserati': 'high_price'
-                                    }
-    dict_changes['fuel'] = {'hybrid_petrol': 'high_price', 'electro': 'high_price'}
-    dict_changes['paint_color'] = {'orange': 'high_price', 'white': 'high_price'}
-    for col in dict_changes.keys():
-        pricing = pricing.replace({col: dict_changes[col]})
-
-    # Load model as a PyFuncModel from mlflow
-    mlflow.set_tracking_uri(mlops_server_uri)
-    print('tracking OK')
-    loaded_model = mlflow.pyfunc.load_model(model_path)
-    print('loaded OK')
-    prediction = loaded_model.predict(pricing)
-    print('prediction OK')
+    record_validation()
+    name = choose_model(x_model, x_routing_key)
+    # Keep a reference to the current model for the whole request, a reload can swap it meanwhile
+    entry = get_current_model(name)
+
+    features = dict(predictionFeatures)
+    if prediction_cache is not None:
+        cache_key = prediction_cache.key(entry, features)
+        prediction = prediction_cache.get(cache_key)
+        if prediction is not None:
+            return serialize({"prediction": prediction}, name)
+
+    start = time.perf_counter()
+    if micro_batcher is not None and name == MAIN_MODEL:
+        # Concurrent requests are scored together, with the model current when their batch runs
+        prediction = await micro_batcher.predict(features)
+    else:
+        # Without DataFrame when the pipeline is compiled (FAST_INFERENCE=true)
+        prediction = await inference.run(predict_one, entry, features)
+    router.served(name, time.perf_counter() - start)
+    router.run_shadow(predict_one, features, name, prediction)
+
+    if prediction_cache is not None:
+        prediction_cache.set(cache_key, prediction)
 
     # Format response
-    response = {"prediction": prediction.tolist()[0]}
-    return response
+    response = {"prediction": prediction}
+    return serialize(response, name)
+
+
+def serialize(content, model=MAIN_MODEL):
+    with timed_stage('serialization'):
+        return JSONResponse(content, headers={"X-Model": model})
+
+
+def choose_model(requested=None, routing_key=None):
+    try:
+        return router.choose(requested, routing_key)
+    except UnknownModel:
+        raise HTTPException(status_code=404, detail=f"Unknown model {requested!r}, expected one of {list(model_caches)}")
+
+
+def get_current_model(name=MAIN_MODEL):
+    entry = model_caches[name].current
+    if entry is None:
+        raise HTTPException(status_code=503, detail=f"Model {name} is not loaded yet")
+    return entry
+
+
+def read_upload(content, filename):
+    """Read an uploaded CSV, Parquet or columnar JSON file ({"column": [values], ...})."""
+    extension = os.path.splitext(filename or '')[1].lower()
+    try:
+        if extension == '.parquet':
+            pricing = pd.read_parquet(io.BytesIO(content))
+        elif extension == '.json':
+            pricing = pd.DataFrame(json.loads(content))
+        else:
+            pricing = pd.read_csv(io.BytesIO(content))
+    except (ValueError, TypeError, OSError, pd.errors.ParserError) as e:
+        # Malformed file: decoding errors are ValueErrors, pyarrow raises OSErrors (ArrowInvalid is a ValueError)
+        raise HTTPException(status_code=422, detail=f"Invalid {extension.lstrip('.') or 'csv'} file: {e}")
+    try:
+        return to_features(pricing)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def to_features(pricing):
+    """Columns of PredictionFeatures of a DataFrame of cars, with the same types (ValueError if missing or invalid)."""
+    missing = [col for col in feature_columns if col not in pricing.columns]
+    if missing:
+        raise ValueError(f"Missing columns in file: {missing}")
+    # Blank cells would be cast to True or NaN, and cars that /predict rejects scored
+    blank = pricing.loc[:, feature_columns].isna()
+    if blank.any(axis=None):
+        rows = {col: pricing.index[blank[col]].tolist()[:10] for col in feature_columns if blank[col].any()}
+        raise ValueError("Missing values in file: " + ", ".join(f"{col} (rows {index})" for col, index in rows.items()))
+    # Same types as PredictionFeatures, integer mileages for instance would be rejected by the model signature
+    try:
+        return pricing.loc[:, feature_columns].astype(feature_dtypes)
+    except (ValueError, TypeError) as e:
+        raise ValueError(f"Invalid values in file: {e}")
+
+
+def stream_predictions(entry, pricing):
+    """Yield predictions as JSON lines, scoring max_batch_size rows at a time."""
+    for start in range(0, pricing.shape[0], max_batch_size):
+        chunk = pricing.iloc[start:start+max_batch_size]
+        predictions = inference.submit(predict_frame, entry, chunk).result()
+        with timed_stage('serialization'):
+            lines = [json.dumps({"prediction": value}) for value in predictions]
+        yield "\n".join(lines) + "\n"
+
+
+@app.post("/predict/batch", tags=["Predict"])
+async def predict_batch(predictionFeatures: List[PredictionFeatures], x_model: Optional[str] = ModelHeader,
+                        x_routing_key: Optional[str] = RoutingKeyHeader):
+    """
+    Prediction for many observations at once, scored in a single call to the model. Endpoint 
+    will return a dictionnary like this:
+
+    ```
+    {'predictions': [PREDICTION_VALUE_1, PREDICTION_VALUE_2, ...]}
+    ```
+
+    You need to give this endpoint a list of cars, each of them described like for /predict. 
+    The list can hold at most MAX_BATCH_SIZE cars (10000 by default), use /predict/batch/file 
+    with `stream=true` for bigger inputs.
+    """
+    record_validation()
+    name = choose_model(x_model, x_routing_key)
+    entry = get_current_model(name)
+    batch_sizes.observe(len(predictionFeatures), endpoint="batch")
+    if len(predictionFeatures) > max_batch_size:
+        raise HTTPException(status_code=413, 
+                            detail=f"Batch of {len(predictionFeatures)} cars exceeds the maximum of {max_batch_size}")
+    records = [dict(features) for features in predictionFeatures]
+    start = time.perf_counter()
+    predictions = await inference.run(predict_records, entry, records)
+    router.served(name, time.perf_counter() - start, len(records))
+    router.run_shadow(predict_records, records, name, predictions)
+    return serialize({"predictions": predictions}, name)
+
+
+@app.post("/predict/batch/file", tags=["Predict"])
+async def predict_batch_file(file: UploadFile = File(...), stream: bool = Query(False),
+                             x_model: Optional[str] = ModelHeader, x_routing_key: Optional[str] = RoutingKeyHeader):
+    """
+    Prediction for all the cars of an uploaded file: CSV, Parquet (`.parquet`) or columnar JSON 
+    (`.json`, like `{"model_key": [...], "mileage": [...], ...}`), with one column per feature 
+    of /predict. Extra columns are ignored. Endpoint will return a dictionnary like this:
+
+    ```
+    {'predictions': [PREDICTION_VALUE_1, PREDICTION_VALUE_2, ...]}
+    ```
+
+    With `stream=true`, there is no limit on the number of rows: the file is scored by chunks of 
+    MAX_BATCH_SIZE rows and predictions are streamed back as JSON lines, one `{"prediction": VALUE}` 
+    per car, in the order of the file. Streamed predictions are not scored by the shadow model.
+    """
+    name = choose_model(x_model, x_routing_key)
+    entry = get_current_model(name)
+    content = await file.read()
+    with timed_stage('validation'):
+        pricing = await run_in_threadpool(read_upload, content, file.filename)
+    batch_sizes.observe(pricing.shape[0], endpoint="file")
+    if stream:
+        return StreamingResponse(stream_predictions(entry, pricing), media_type="application/x-ndjson",
+                                 headers={"X-Model": name})
+    if pricing.shape[0] > max_batch_size:
+        raise HTTPException(status_code=413, 
+                            detail=f"File of {pricing.shape[0]} cars exceeds the maximum of {max_batch_size}, use stream=true")
+    start = time.perf_counter()
+    predictions = await inference.run(predict_frame, entry, pricing)
+    router.served(name, time.perf_counter() - start, pricing.shape[0])
+    router.run_shadow(predict_frame, pricing, name, predictions)
+    return serialize({"predictions": predictions}, name)
+
+
+job_runner = JobRunner(jobs_dir, to_features, job_chunk_size, job_workers, job_retention, job_max_finished)
+
+
+def get_job(job_id):
+    job = job_runner.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+
+def describe_job(job):
+    status = job.describe()
+    status["status_url"] = f"/jobs/{job.job_id}"
+    status["result_url"] = f"/jobs/{job.job_id}/result" if job.status == 'done' else None
+    return status
+
+
+@app.post("/jobs", tags=["Jobs"], status_code=202)
+async def submit_job(file: UploadFile = File(...), x_model: Optional[str] = ModelHeader,
+                     x_routing_key: Optional[str] = RoutingKeyHeader):
+    """
+    Score all the cars of a CSV or Parquet file (`.parquet`) in the background, with one column per 
+    feature of /predict. The file is scored by chunks of JOB_CHUNK_SIZE cars, in parallel on 
+    JOB_WORKERS threads, one job at a time. Endpoint will return the id of the job right away:
+
+    ```
+    {'job_id': JOB_ID, 'status': 'queued', 'status_url': '/jobs/JOB_ID', ...}
+    ```
+
+    Poll /jobs/JOB_ID for the progress and the number of cars scored per second, and download the 
+    predictions from /jobs/JOB_ID/result once the job is `done`: the cars of the file, in the same 
+    format, with a `prediction` column. The model serving the job is chosen like for /predict, 
+    when the job is submitted. Finished jobs are kept JOB_RETENTION seconds (a day by default), 
+    and at most JOB_MAX_FINISHED of them.
+    """
+    name = choose_model(x_model, x_routing_key)
+    entry = get_current_model(name)
+    try:
+        job = await run_in_threadpool(job_runner.submit, file.file, file.filename, name, entry)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return describe_job(job)
+
+
+@app.get("/jobs", tags=["Jobs"])
+async def list_jobs():
+    """Jobs submitted since the API started, with their status."""
+    return {"jobs": [describe_job(job) for job in job_runner.jobs()]}
+
+
+@app.get("/jobs/{job_id}", tags=["Jobs"])
+async def job_status(job_id: str):
+    """
+    Status of a job (`queued`, `running`, `done`, `failed` or `cancelled`), number of cars scored 
+    out of the cars of the file, progress between 0 and 1, and cars scored per second.
+    """
+    return describe_job(get_job(job_id))
+
+
+@app.get("/jobs/{job_id}/result", tags=["Jobs"])
+async def job_result(job_id: str):
+    """File of predictions of a job once it is `done` (409 before)."""
+    job = get_job(job_id)
+    if job.status != 'done':
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return FileResponse(job.output_path, filename=os.path.basename(job.output_path))
+
+
+@app.delete("/jobs/{job_id}", tags=["Jobs"])
+async def delete_job(job_id: str):
+    """Cancel a job if it is not finished yet, and delete its files."""
+    job = job_runner.delete(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return {"job_id": job_id, "status": "deleted"}
+
+
+@app.get("/ready", tags=["Health"])
+async def ready():
+    """
+    Readiness probe: returns 200 once the model is loaded in memory and warmed up, 503 before.
+    The other models of MODEL_ROUTES are loaded afterwards, see /models.
+    """
+    entry = model_cache.current
+    if entry is None:
+        return JSONResponse(status_code=503, content={"status": "loading", "error": model_cache.last_error})
+    return {"status": "ready", "model_path": entry.model_path, "model_version": entry.version}
+
+
+@app.get("/models", tags=["Health"])
+async def models():
+    """
+    Models resident in memory (the main one of MODEL_PATH and the routes of MODEL_ROUTES), with 
+    their weight in the routing of the requests and the shadow model. Their latency and the 
+    differences between the shadow predictions and the served ones are in /metrics.
+    """
+    return {"models": router.describe()}
+
+
+@app.post("/model/reload", tags=["Health"])
+async def reload_model(reloadRequest: Optional[ReloadRequest] = None):
+    """
+    Load the model again from MLflow (or the one at `model_path` if given) and swap it in once 
+    it is warmed up. Requests being served keep the previous model until they are done, and the 
+    previous model stays in place if loading fails. `model` is the name of the route to reload 
+    (see /models), the main model by default.
+    """
+    reloadRequest = reloadRequest or ReloadRequest()
+    if reloadRequest.model not in model_caches:
+        raise HTTPException(status_code=404, detail=f"Unknown model {reloadRequest.model!r}, expected one of {list(model_caches)}")
+    try:
+        entry = await run_in_threadpool(model_caches[reloadRequest.model].load, reloadRequest.model_path, True)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Model reload failed: {e}")
+    publish_model(entry, serving_mode, reloadRequest.model)
+    return {"status": "reloaded", "model": reloadRequest.model, "model_path": entry.model_path,
+            "model_version": entry.version, "load_seconds": entry.load_seconds}
+
+
+@app.get("/metrics", tags=["Health"], response_class=PlainTextResponse)
+async def metrics():
+    """
+    Metrics of the API in the Prometheus text format: requests by route and status, their 
+    latency and the time spent in each stage (validation, feature mapping, inference, 
+    serialization, model loading), batch sizes, hits of the prediction cache, versions of the 
+    models served, their latency and the differences of the shadow model, startup time of the 
+    API, and queue depth and waiting times of the micro-batcher (MICRO_BATCHING=true).
+    """
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
 
 # @app.exception_handler(Exception)
 # async def global_exception_handler(_: Request, ex: Exception):
@@ -118,5 +542,8 @@ async def predict(predictionFeatures: PredictionFeatures):
 #         content={"detail": str(ex)}
 #     )
 
+startup_seconds.set(time.perf_counter() - started_at, phase='import')
+
 if __name__=="__main__":
+    import uvicorn
     uvicorn.run(app, host='localhost', port=default_port)
\ No newline at end of file
@@ -0,0 +1,101 @@
+import asyncio
+import time
+
+from metrics import registry
+
+queue_depth = registry.gauge(
+    "getaround_microbatch_queue_depth", "Number of single-car predictions waiting to be batched")
+batch_sizes = registry.histogram(
+    "getaround_microbatch_batch_size", "Number of cars scored together by the micro-batcher",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+wait_seconds = registry.histogram(
+    "getaround_microbatch_wait_seconds", "Time spent by a prediction in the queue before being scored",
+    buckets=(0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1))
+
+
+class MicroBatcher:
+    """
+    Groups concurrent single-car predictions into one model call.
+
+    Requests wait at most `max_wait_ms` after the first one arrived, or until
+    `max_batch_size` of them are queued. The batch is then scored by the coroutine
+    `predict_fn(rows)` (off the event loop) and each request gets its own result back.
+    """
+
+    def __init__(self, predict_fn, max_batch_size=64, max_wait_ms=5):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = None
+        self._worker = None
+
+    def start(self):
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def predict(self, row):
+        """Queue one car (dict of features) and wait for its prediction."""
+        future = asyncio.get_running_loop().create_future()
+        queue_depth.inc()
+        await self._queue.put((row, future, time.perf_counter()))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        while True:
+            batch = await self._collect()
+            queue_depth.dec(len(batch))
+            batch_sizes.observe(len(batch))
+            now = time.perf_counter()
+            for _, _, queued_at in batch:
+                wait_seconds.observe(now - queued_at)
+
+            rows = [row for row, _, _ in batch]
+            try:
+                predictions = await self.predict_fn(rows)
+            except Exception as e:
+                if len(batch) == 1:
+                    self._set_exception(batch[0][1], e)
+                    continue
+                # One invalid car (e.g. an unknown category) must not fail the requests batched with it:
+                # the cars are scored again one at a time and only the failing ones get the error
+                for row, future, _ in batch:
+                    try:
+                        self._set_result(future, (await self.predict_fn([row]))[0])
+                    except Exception as row_error:
+                        self._set_exception(future, row_error)
+                continue
+            for (_, future, _), prediction in zip(batch, predictions):
+                self._set_result(future, prediction)
+
+    @staticmethod
+    def _set_result(future, prediction):
+        # The request may have been cancelled (client gone) while waiting
+        if not future.done():
+            future.set_result(prediction)
+
+    @staticmethod
+    def _set_exception(future, error):
+        if not future.done():
+            future.set_exception(error)
@@ -0,0 +1,113 @@
+import asyncio
+import contextvars
+import multiprocessing
+import os
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+import pandas as pd
+
+from model_cache import ModelCache
+
+
+def default_workers():
+    """Inference workers per API worker: the cores are shared between the WEB_CONCURRENCY API workers."""
+    web_workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    return max(1, (os.cpu_count() or 1) // web_workers)
+
+
+def default_nthread(workers):
+    """Threads of the model itself, so that API workers x inference workers x threads <= cores."""
+    web_workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    return max(1, (os.cpu_count() or 1) // (web_workers * workers))
+
+
+def predict_one(entry, features):
+    return entry.predict_one(features)
+
+
+def predict_frame(entry, pricing):
+    return entry.predict(pricing).tolist()
+
+
+def predict_records(entry, records):
+    if not records:
+        return []
+    return predict_frame(entry, pd.DataFrame(records))
+
+
+# Model of each child process of the process backend
+_child_cache = None
+
+
+def _init_child(tracking_uri, model_path, warmup_input, fast_path, nthread, serving_mode):
+    global _child_cache
+    _child_cache = ModelCache(tracking_uri, model_path, warmup_input, fast_path=fast_path, nthread=nthread,
+                              serving_mode=serving_mode)
+    _child_cache.load()
+
+
+def _child_version():
+    return _child_cache.current.version
+
+
+def _child_call(function, payload):
+    return function(_child_cache.current, payload)
+
+
+class InferenceExecutor:
+    """
+    Runs the predictions off the event loop, so that a slow prediction does not hold the
+    other requests (health checks included) of the same API worker.
+
+    - "thread": a thread pool sharing the models of the ModelCache (XGBoost and NumPy
+      release the GIL while predicting)
+    - "process": a pool of processes, each with its own copy of the model loaded at start,
+      restarted with the new model when the ModelCache swaps it
+    """
+
+    def __init__(self, model_cache, backend='thread', workers=None):
+        if backend not in ('thread', 'process'):
+            raise ValueError(f"Unknown inference backend {backend!r}, expected thread or process")
+        self.model_cache = model_cache
+        self.backend = backend
+        self.workers = workers or default_workers()
+        self._pool = None
+
+    def start(self):
+        if self.backend == 'thread':
+            self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='inference')
+        else:
+            self._pool = self._process_pool(self.model_cache.model_path)
+            self.model_cache.on_swap(self._restart)
+
+    def shutdown(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def _process_pool(self, model_path, wait=False):
+        pool = ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context('spawn'), initializer=_init_child,
+            initargs=(self.model_cache.tracking_uri, model_path, self.model_cache.warmup_input,
+                      self.model_cache.fast_path, self.model_cache.nthread, self.model_cache.serving_mode))
+        # Children load the model when they start: start them now rather than on the first requests
+        started = [pool.submit(_child_version) for _ in range(self.workers)]
+        if wait:
+            for future in started:
+                future.result()
+        return pool
+
+    def _restart(self, entry):
+        # The new pool is ready before the swap, predictions already submitted finish in the previous one
+        previous, self._pool = self._pool, self._process_pool(entry.model_path, wait=True)
+        previous.shutdown(wait=False)
+
+    def submit(self, function, entry, payload):
+        """Run `function(entry, payload)` in the pool, returns a concurrent.futures.Future."""
+        if self.backend == 'thread':
+            # In the context of the request, so that the stages timed by the model are reported with it
+            return self._pool.submit(contextvars.copy_context().run, function, entry, payload)
+        return self._pool.submit(_child_call, function, payload)
+
+    async def run(self, function, entry, payload):
+        return await asyncio.wrap_future(self.submit(function, entry, payload))
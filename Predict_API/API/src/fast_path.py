@@ -0,0 +1,141 @@
+import numpy as np
+
+# scikit-learn is imported when a pipeline is compiled, not with this module which the API imports at startup
+
+
+class UnknownCategory(ValueError):
+    """Raised for a category the encoder has not seen: the pandas path gives the real error."""
+
+
+class CompiledPipeline:
+    """
+    Single-car inference without pandas, compiled from a fitted train.py pipeline.
+
+    The fitted "Preprocessing" step is turned into a fixed layout of the model inputs:
+    imputation value, mean and scale for each numeric feature, and the input index of
+    each known category for the one-hot encoded ones. A car is then written straight
+    into a NumPy row of that layout, which is given to the regressor.
+    """
+
+    def __init__(self, pipeline, mapper=None):
+        from sklearn.compose import ColumnTransformer
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import OneHotEncoder
+        from features import DataCleaner, FeatureMapper
+
+        steps = dict(pipeline.named_steps) if isinstance(pipeline, Pipeline) else {}
+        preprocessor = steps.get('Preprocessing')
+        self.regressor = steps.get('Regressor')
+        if not isinstance(preprocessor, ColumnTransformer) or self.regressor is None:
+            raise NotImplementedError("Pipeline is not a Preprocessing + Regressor pipeline from train.py")
+        # Models logged before the Mapping step are mapped by the API (see model_cache.legacy_mapper)
+        self.mapper = steps.get('Mapping', mapper)
+        if self.mapper is not None and not isinstance(self.mapper, FeatureMapper):
+            raise NotImplementedError(f"Unsupported mapping step {type(self.mapper).__name__}")
+        self.cleaner = steps.get('Cleaning')
+        if self.cleaner is not None and not isinstance(self.cleaner, DataCleaner):
+            raise NotImplementedError(f"Unsupported cleaning step {type(self.cleaner).__name__}")
+
+        self.numeric = []      # (feature, input index, imputed value, mean, scale)
+        self.categorical = []  # (feature, {category: input index or None if dropped}, unknown allowed)
+        position = 0
+        for name, transformer, columns in preprocessor.transformers_:
+            if isinstance(transformer, str) and transformer == 'drop':
+                continue
+            if isinstance(transformer, OneHotEncoder):
+                position = self._compile_one_hot(transformer, columns, position)
+            else:
+                position = self._compile_numeric(transformer, columns, position)
+        self.n_inputs = position
+
+        # ColumnTransformer decides at fit time to output a sparse matrix, in which case XGBoost
+        # takes the zeros as missing values: the row is given the same way to keep predictions identical
+        self.zeros_as_missing = bool(getattr(preprocessor, 'sparse_output_', False)) \
+            and type(self.regressor).__module__.startswith('xgboost')
+
+    def _compile_numeric(self, transformer, columns, position):
+        from sklearn.impute import SimpleImputer
+        from sklearn.pipeline import Pipeline
+        from sklearn.preprocessing import StandardScaler
+
+        steps = transformer.steps if isinstance(transformer, Pipeline) else [(None, transformer)]
+        n = len(columns)
+        fill, mean, scale = np.full(n, np.nan), np.zeros(n), np.ones(n)
+        for _, step in steps:
+            if isinstance(step, SimpleImputer):
+                fill = np.asarray(step.statistics_, dtype=float)
+            elif isinstance(step, StandardScaler):
+                if step.with_mean:
+                    mean = step.mean_
+                if step.with_std:
+                    scale = step.scale_
+            else:
+                raise NotImplementedError(f"Unsupported numeric step {type(step).__name__}")
+        for i, column in enumerate(columns):
+            self.numeric.append((column, position + i, fill[i], mean[i], scale[i]))
+        return position + n
+
+    def _compile_one_hot(self, encoder, columns, position):
+        if getattr(encoder, '_infrequent_enabled', False):
+            raise NotImplementedError("Infrequent categories of OneHotEncoder are not supported")
+        drop_idx = encoder.drop_idx_ if encoder.drop_idx_ is not None else [None] * len(columns)
+        for column, categories, dropped in zip(columns, encoder.categories_, drop_idx):
+            layout = {}
+            for i, category in enumerate(categories):
+                if dropped is not None and i == dropped:
+                    layout[category] = None
+                else:
+                    layout[category] = position
+                    position += 1
+            self.categorical.append((column, layout, encoder.handle_unknown != 'error'))
+        return position
+
+    def encode(self, features, row=None):
+        """Write the model inputs of one car (dict of raw features) into `row`."""
+        row = np.zeros(self.n_inputs) if row is None else row
+        row.fill(0)
+        cleaner = self.cleaner
+        for feature, index, fill, mean, scale in self.numeric:
+            value = features[feature]
+            if cleaner is not None:
+                value = cleaner.clean_value(feature, value)
+            if value is None or value != value:
+                value = fill
+            row[index] = (value - mean) / scale
+        mapper = self.mapper
+        for feature, layout, unknown_allowed in self.categorical:
+            value = features[feature]
+            if cleaner is not None:
+                value = cleaner.clean_value(feature, value)
+            if mapper is not None:
+                value = mapper.map_value(feature, value)
+            try:
+                index = layout[value]
+            except KeyError:
+                if unknown_allowed:
+                    continue
+                raise UnknownCategory(f"Unknown category {value!r} for {feature}")
+            if index is not None:
+                row[index] = 1
+        return row
+
+    def predict_one(self, features):
+        row = self.encode(features).reshape(1, -1)
+        if self.zeros_as_missing:
+            row[row == 0] = np.nan
+        return float(self.regressor.predict(row)[0])
+
+
+def check_parity(compiled, model, pricing, rtol=1e-6):
+    """
+    Compare the compiled path with `model.predict` (the pandas path) on every car of `pricing`,
+    returns the largest absolute difference and raises AssertionError if they differ.
+    """
+    expected = np.asarray(model.predict(pricing), dtype=float)
+    rows = pricing.to_dict(orient='records')
+    obtained = np.array([compiled.predict_one(row) for row in rows])
+    if not np.allclose(obtained, expected, rtol=rtol, atol=1e-6):
+        worst = int(np.argmax(np.abs(obtained - expected)))
+        raise AssertionError(f"Compiled prediction {obtained[worst]} differs from {expected[worst]} "
+                             f"for car {rows[worst]}")
+    return float(np.max(np.abs(obtained - expected))) if len(rows) else 0.0
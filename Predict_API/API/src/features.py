@@ -0,0 +1,151 @@
+import numpy as np
+import pandas as pd
+from sklearn.base import BaseEstimator, TransformerMixin
+
+# Brands, fuels and colors too rare to be learnt on their own, grouped by price range
+DEFAULT_MAPPING = {
+    'model_key': {'Fiat': 'low_price', 'Mazda': 'low_price', 'Ford': 'low_price', 'Mercedes': 'low_price',
+                  'Porsche': 'medium_price', 'Honda': 'medium_price', 'Yamaha': 'medium_price',
+                  'Lamborghini': 'medium_price', 'Alfa Romeo': 'medium_price', 'KIA Motors': 'medium_price',
+                  'Opel': 'medium_price',
+                  'Suzuki': 'high_price', 'Mini': 'high_price', 'Lexus': 'high_price', 'Maserati': 'high_price'
+                  },
+    'fuel': {'hybrid_petrol': 'high_price', 'electro': 'high_price'},
+    'paint_color': {'orange': 'high_price', 'white': 'high_price'},
+}
+
+# Valid values of the numeric features, the others are measurement errors. The first train.py only
+# replaced engine powers of 0 and above 400: engine powers are whole horse powers, so the bound of 1
+# also replaces negative ones, of which the dataset has none (see test_cleaning_rules in test.py)
+VALID_RANGES = {'mileage': (0, 1000000), 'engine_power': (1, 400)}
+# Columns whose rare categories are left out of the training of the wo10Cats models
+RARE_COLUMNS = ['fuel', 'model_key', 'paint_color']
+
+
+class DataCleaner(BaseEstimator, TransformerMixin):
+    """
+    Cleaning of the raw cars, the step before "Mapping" in the pipelines logged by train.py:
+
+    - numeric values outside of their range in `ranges` are replaced by NaN, to be imputed
+    - with `rare_threshold`, the categories of `rare_columns` seen `rare_threshold` times or
+      less at fit time are rare: `drop_rare` leaves their cars out of the training set and
+      `transform` replaces them by the most frequent category of the column when serving
+
+    Each rule is one mask over a whole column. The rare categories are learnt at fit time and
+    saved with the pipeline, so a model is always served with the rules it was trained with.
+    """
+
+    def __init__(self, ranges=None, rare_columns=None, rare_threshold=None):
+        self.ranges = ranges
+        self.rare_columns = rare_columns
+        self.rare_threshold = rare_threshold
+
+    def combinations(self, X):
+        """Number of cars of each combination of categories of `rare_columns`, all fit needs to know of X."""
+        columns = list(self.rare_columns or [])
+        if not self.rare_threshold or not columns:
+            return pd.Series(dtype='int64')
+        return X.astype({col: object for col in columns}).groupby(columns, dropna=False).size()
+
+    def fit(self, X, y=None):
+        return self.fit_combinations(self.combinations(X))
+
+    def fit_combinations(self, combinations):
+        """
+        Fit from the output of `combinations`, which can be summed over chunks of a dataset
+        too large to be loaded at once (see ml/out_of_core.py).
+        """
+        self.rare_categories_ = {}
+        self.fallbacks_ = {}
+        if combinations.empty:
+            return self
+        combinations = combinations.rename('cars').reset_index()
+        kept = np.ones(combinations.shape[0], dtype=bool)
+        for col in self.rare_columns:
+            # Counted among the cars left by the previous columns
+            counts = combinations.loc[kept, :].groupby(col)['cars'].sum()
+            counts = counts.loc[counts > 0].sort_values(ascending=False, kind='stable')
+            rare = counts.index[counts <= self.rare_threshold]
+            self.rare_categories_[col] = pd.Index(rare)
+            self.fallbacks_[col] = counts.index[0]
+            kept &= ~combinations[col].isin(rare).to_numpy()
+        return self
+
+    def rare_mask(self, X):
+        """Cars with a rare category."""
+        mask = np.zeros(X.shape[0], dtype=bool)
+        for col, rare in self.rare_categories_.items():
+            mask |= X[col].isin(rare).to_numpy()
+        return mask
+
+    def drop_rare(self, X):
+        """X without the cars of a rare category, in a single selection."""
+        return X.loc[~self.rare_mask(X), :]
+
+    def clean_value(self, col, value):
+        """Cleaned single value, for the callers that do not work on DataFrames."""
+        if self.ranges and col in self.ranges:
+            low, high = self.ranges[col]
+            return value if value is not None and low <= value <= high else np.nan
+        rare = self.rare_categories_.get(col)
+        if rare is not None and value in rare:
+            return self.fallbacks_[col]
+        return value
+
+    def transform(self, X):
+        X = X.copy()
+        for col, (low, high) in (self.ranges or {}).items():
+            if col in X.columns:
+                values = X[col].astype(float)
+                X[col] = values.where(values.between(low, high))
+        for col, rare in self.rare_categories_.items():
+            if col in X.columns:
+                X[col] = X[col].where(~X[col].isin(rare), self.fallbacks_[col])
+        return X
+
+    def to_dict(self):
+        """Fitted rules as plain JSON types, for the runtimes without scikit-learn (see onnx_model.DictCleaner)."""
+        return {
+            'ranges': {col: [float(low), float(high)] for col, (low, high) in (self.ranges or {}).items()},
+            'rare_categories': {col: [str(value) for value in rare] for col, rare in self.rare_categories_.items()},
+            'fallbacks': {col: str(value) for col, value in self.fallbacks_.items()},
+        }
+
+
+class FeatureMapper(BaseEstimator, TransformerMixin):
+    """
+    Replaces categories of some columns by their group, e.g. rare brands by their price range.
+
+    It is the first step of the pipelines logged by train.py, so that training and serving
+    always apply the same grouping. The mapping is compiled at fit time into one index of
+    source categories and one array of groups per column: transforming a batch is then a
+    single vectorized lookup per column. Values absent from the mapping are kept as is.
+    """
+
+    def __init__(self, mapping=None):
+        self.mapping = mapping
+
+    def fit(self, X=None, y=None):
+        self.lookups_ = {
+            col: (pd.Index(list(changes.keys())), np.array(list(changes.values()), dtype=object))
+            for col, changes in (self.mapping or {}).items() if changes
+        }
+        return self
+
+    def map_value(self, col, value):
+        """Group of a single value, for the callers that do not work on DataFrames."""
+        lookup = self.lookups_.get(col)
+        if lookup is None:
+            return value
+        position = lookup[0].get_indexer([value])[0]
+        return value if position < 0 else lookup[1][position]
+
+    def transform(self, X):
+        X = X.copy()
+        for col, (categories, groups) in self.lookups_.items():
+            if col not in X.columns:
+                continue
+            values = X[col].to_numpy(dtype=object)
+            positions = categories.get_indexer(values)
+            X[col] = np.where(positions >= 0, groups[positions], values)
+        return X
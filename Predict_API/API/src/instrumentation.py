@@ -0,0 +1,107 @@
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from starlette.datastructures import MutableHeaders
+
+from metrics import registry
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+requests_total = registry.counter(
+    "getaround_requests_total", "Requests answered by the API", ["method", "path", "status"])
+request_seconds = registry.histogram(
+    "getaround_request_seconds", "Time from the reception of a request to the start of its response",
+    LATENCY_BUCKETS, ["path"])
+stage_seconds = registry.histogram(
+    "getaround_stage_seconds", "Time spent in each stage of the predictions: validation, feature_mapping, "
+    "inference, serialization and model_load", LATENCY_BUCKETS, ["stage"])
+batch_sizes = registry.histogram(
+    "getaround_batch_size", "Number of cars scored per call to the batch endpoints",
+    (1, 10, 100, 1000, 10000, 100000, 1000000), ["endpoint"])
+model_info = registry.gauge(
+    "getaround_model_info", "Models currently served, always 1 (see the labels)",
+    ["model", "model_path", "version", "serving_mode"])
+startup_seconds = registry.gauge(
+    "getaround_startup_seconds", "Startup of the API: import of the modules, loading of the first model, "
+    "and time from the start of the import until the API is ready", ["phase"])
+
+# Stage durations of the request being served, filled by the endpoints and read by the middleware
+_request_timings = ContextVar('request_timings', default=None)
+
+
+def record_stage(stage, seconds):
+    stage_seconds.observe(seconds, stage=stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings['stages'][stage] = timings['stages'].get(stage, 0.0) + seconds
+
+
+@contextmanager
+def timed_stage(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start)
+
+
+def record_validation():
+    """Called first thing by the endpoints: FastAPI has read and validated the body since the request came in."""
+    timings = _request_timings.get()
+    if timings is not None:
+        record_stage('validation', time.perf_counter() - timings['start'])
+
+
+def publish_model(entry, serving_mode, model='main'):
+    """Version and loading time of the model just swapped in for the route `model` (see routing.py)."""
+    model_info.remove(model=model)
+    model_info.set(1, model=model, model_path=entry.model_path, version=entry.version, serving_mode=serving_mode)
+    stage_seconds.observe(entry.load_seconds, stage='model_load')
+
+
+def server_timing(timings, duration):
+    """Server-Timing header value: duration of each stage and of the whole request, in milliseconds."""
+    metrics = [f"{stage};dur={seconds * 1000:.3f}" for stage, seconds in timings['stages'].items()]
+    return ", ".join(metrics + [f"total;dur={duration * 1000:.3f}"])
+
+
+class InstrumentationMiddleware:
+    """
+    Counts the requests by route and status and times them. With `timing_header`, responses
+    also carry a Server-Timing header with the duration of each stage of the request.
+
+    A plain ASGI middleware rather than @app.middleware("http"): the endpoint runs in the same
+    task, so the stages it records are visible here, and no extra task is spawned per request.
+    """
+
+    def __init__(self, app, timing_header=False):
+        self.app = app
+        self.timing_header = timing_header
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            return await self.app(scope, receive, send)
+        timings = {'start': time.perf_counter(), 'stages': {}}
+        token = _request_timings.set(timings)
+        status = 500
+
+        async def send_with_timings(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                duration = time.perf_counter() - timings['start']
+                timings['duration'] = duration
+                if self.timing_header:
+                    MutableHeaders(scope=message).append('Server-Timing', server_timing(timings, duration))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timings)
+        finally:
+            _request_timings.reset(token)
+            # Route template rather than the raw path, so that the number of series stays bounded
+            route = scope.get('route')
+            path = getattr(route, 'path', 'unmatched')
+            requests_total.inc(method=scope['method'], path=path, status=status)
+            request_seconds.observe(timings.get('duration', time.perf_counter() - timings['start']), path=path)
@@ -0,0 +1,288 @@
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+
+import numpy as np
+import pandas as pd
+
+from metrics import registry
+
+JOB_FORMATS = ('.csv', '.parquet')
+
+jobs_total = registry.counter(
+    "getaround_jobs_total", "Bulk scoring jobs by final status", ["status"])
+job_rows_total = registry.counter(
+    "getaround_job_rows_total", "Cars scored by the bulk scoring jobs")
+jobs_queued = registry.gauge(
+    "getaround_jobs_queued", "Bulk scoring jobs waiting for the job runner")
+
+
+class JobCancelled(Exception):
+    pass
+
+
+def read_chunks(path, chunksize):
+    """DataFrames of `chunksize` rows of a CSV or Parquet file, read one at a time."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        for batch in pq.ParquetFile(path).iter_batches(chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunksize):
+            # A file with a header only gives an empty chunk
+            if not chunk.empty:
+                yield chunk
+
+
+def count_rows(path):
+    """Number of cars of a job file: from the metadata of a Parquet file, by counting the lines of a CSV."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).metadata.num_rows
+    lines, last = 0, b'\n'
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            lines += block.count(b'\n')
+            last = block[-1:]
+    # Header line excluded, last line counted even without a final newline
+    return lines - 1 + (last != b'\n')
+
+
+def empty_frame(path):
+    """The columns of a job file, without any row."""
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        return pq.ParquetFile(path).schema_arrow.empty_table().to_pandas()
+    return pd.read_csv(path, nrows=0)
+
+
+class ResultWriter:
+    """Scored chunks appended, in order, to a CSV or Parquet file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+        self._parquet = None
+
+    def write(self, chunk):
+        if self.path.endswith('.parquet'):
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+            table = pa.Table.from_pandas(chunk, preserve_index=False)
+            if self._parquet is None:
+                self._parquet = pq.ParquetWriter(self.path, table.schema)
+            self._parquet.write_table(table.cast(self._parquet.schema))
+        else:
+            header = self._file is None
+            if header:
+                self._file = open(self.path, 'w', newline='')
+            chunk.to_csv(self._file, header=header, index=False)
+
+    def close(self):
+        if self._parquet is not None:
+            self._parquet.close()
+        if self._file is not None:
+            self._file.close()
+
+
+@dataclass
+class Job:
+    """
+    A file of cars to score with the model `entry` (a LoadedModel) of the route `model`. The
+    model is only held until the job ends, so that finished jobs do not keep reloaded models in memory.
+    """
+    job_id: str
+    input_path: str
+    output_path: str
+    model: str
+    entry: object
+    model_version: str = None
+    status: str = 'queued'  # queued, running, done, failed or cancelled
+    rows_total: int = None
+    rows_done: int = 0
+    error: str = None
+    submitted_at: float = field(default_factory=time.time)
+    started_at: float = None
+    finished_at: float = None
+    cancelled: bool = False
+
+    @property
+    def partial_path(self):
+        """Result being written, renamed to output_path once complete."""
+        directory, name = os.path.split(self.output_path)
+        return os.path.join(directory, 'partial_' + name)
+
+    def describe(self):
+        elapsed = ((self.finished_at or time.time()) - self.started_at) if self.started_at else 0.0
+        return {
+            "job_id": self.job_id, "status": self.status, "model": self.model, "model_version": self.model_version,
+            "rows_total": self.rows_total, "rows_done": self.rows_done,
+            "progress": self.rows_done / self.rows_total if self.rows_total else (1.0 if self.status == 'done' else 0.0),
+            "elapsed_seconds": elapsed, "rows_per_second": self.rows_done / elapsed if elapsed else 0.0,
+            "error": self.error,
+        }
+
+
+class JobRunner:
+    """
+    Scores the files of the bulk scoring jobs in the background, one job at a time, so that
+    the whole fleet can be repriced without holding an HTTP request open.
+
+    The file is read by chunks of `chunksize` cars, scored by `workers` threads (XGBoost and
+    NumPy release the GIL) with at most `workers` + 1 chunks in memory, and the chunks are
+    written in order to the result file: the cars of the input with a `prediction` column.
+    `prepare(chunk)` returns the features of a chunk for the model (ValueError if invalid).
+    Each job has its directory in `directory`, with its input and result files. Finished jobs
+    are forgotten, files included, `retention` seconds after they end, and beyond the
+    `max_finished` most recent ones.
+    """
+
+    def __init__(self, directory, prepare, chunksize=50000, workers=1, retention=86400, max_finished=100):
+        self.directory = directory
+        self.prepare = prepare
+        self.chunksize = chunksize
+        self.workers = workers
+        self.retention = retention
+        self.max_finished = max_finished
+        self._jobs = {}
+        self._jobs_lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pool = None
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._pool = ThreadPoolExecutor(self.workers, thread_name_prefix='job')
+        self._thread = threading.Thread(target=self._run, name='job-runner', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        if self._thread is not None:
+            for job in self._jobs.values():
+                if job.status in ('queued', 'running'):
+                    job.cancelled = True
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    def submit(self, source, filename, model, entry):
+        """Queue the scoring of the file object `source` (copied to the job directory), returns the Job."""
+        extension = os.path.splitext(filename or '')[1].lower()
+        if extension not in JOB_FORMATS:
+            raise ValueError(f"Unsupported file {filename!r}, expected one of {JOB_FORMATS}")
+        job_id = uuid.uuid4().hex
+        os.makedirs(os.path.join(self.directory, job_id))
+        job = Job(job_id, os.path.join(self.directory, job_id, 'input' + extension),
+                  os.path.join(self.directory, job_id, 'predictions' + extension), model, entry, entry.version)
+        with open(job.input_path, 'wb') as f:
+            shutil.copyfileobj(source, f, 1 << 20)
+        try:
+            # Missing columns are reported now rather than by the job
+            self.prepare(empty_frame(job.input_path))
+        except Exception:
+            shutil.rmtree(os.path.join(self.directory, job_id), ignore_errors=True)
+            raise
+        self._expire()
+        with self._jobs_lock:
+            self._jobs[job_id] = job
+        jobs_queued.inc()
+        self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._jobs_lock:
+            return list(self._jobs.values())
+
+    def delete(self, job_id):
+        """Forget a job: it is cancelled if not finished yet, and its files are removed once it is."""
+        with self._jobs_lock:
+            job = self._jobs.pop(job_id, None)
+        if job is None:
+            return None
+        job.cancelled = True
+        if job.status not in ('queued', 'running'):
+            shutil.rmtree(os.path.dirname(job.input_path), ignore_errors=True)
+        return job
+
+    def _expire(self):
+        """Forget the finished jobs past the retention time, and the oldest beyond max_finished."""
+        with self._jobs_lock:
+            finished = sorted([job for job in self._jobs.values() if job.finished_at is not None],
+                              key=lambda job: job.finished_at)
+            expired = [job for job in finished if job.finished_at < time.time() - self.retention]
+            expired += [job for job in finished[:max(0, len(finished) - self.max_finished)] if job not in expired]
+            for job in expired:
+                del self._jobs[job.job_id]
+        for job in expired:
+            shutil.rmtree(os.path.dirname(job.input_path), ignore_errors=True)
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            jobs_queued.dec()
+            job.started_at = time.time()
+            job.status = 'running'
+            try:
+                if job.cancelled:
+                    raise JobCancelled()
+                job.rows_total = count_rows(job.input_path)
+                self._score(job)
+                job.status = 'done'
+            except JobCancelled:
+                job.status = 'cancelled'
+            except Exception as e:
+                job.status = 'failed'
+                job.error = f"{type(e).__name__}: {e}"
+            job.finished_at = time.time()
+            job.entry = None
+            jobs_total.inc(status=job.status)
+            if job.status != 'done' and os.path.exists(job.partial_path):
+                os.remove(job.partial_path)
+            if job.job_id not in self._jobs:
+                shutil.rmtree(os.path.dirname(job.input_path), ignore_errors=True)
+            print(f'job {job.job_id} {job.status}: {job.rows_done} cars in {job.finished_at - job.started_at:.1f}s')
+            self._expire()
+
+    def _score_chunk(self, entry, chunk):
+        predictions = entry.predict(self.prepare(chunk))
+        return chunk.assign(prediction=np.asarray(predictions, dtype=float))
+
+    def _score(self, job):
+        writer = ResultWriter(job.partial_path)
+        pending = deque()
+        try:
+            for chunk in read_chunks(job.input_path, self.chunksize):
+                pending.append(self._pool.submit(self._score_chunk, job.entry, chunk))
+                while len(pending) > self.workers or (pending and pending[0].done()):
+                    self._write(job, writer, pending.popleft().result())
+            while pending:
+                self._write(job, writer, pending.popleft().result())
+            if not job.rows_done:
+                # File without any car: the result only has the columns
+                writer.write(empty_frame(job.input_path).assign(prediction=np.array([], dtype=float)))
+        finally:
+            for future in pending:
+                future.cancel()
+            writer.close()
+        os.replace(job.partial_path, job.output_path)
+
+    def _write(self, job, writer, scored):
+        if job.cancelled:
+            raise JobCancelled()
+        writer.write(scored)
+        job.rows_done += scored.shape[0]
+        job_rows_total.inc(scored.shape[0])
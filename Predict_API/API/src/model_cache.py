@@ -0,0 +1,197 @@
+import threading
+import time
+from dataclasses import dataclass, field
+
+import pandas as pd
+
+from fast_path import CompiledPipeline, UnknownCategory, check_parity
+from instrumentation import timed_stage
+
+# mlflow and scikit-learn are imported when a model needs them, not when the API starts: the
+# ONNX serving mode of a local model does without them (see startup_profile.py)
+
+
+@dataclass
+class LoadedModel:
+    """A model resident in memory, with what we need to identify it."""
+    model_path: str
+    version: str
+    model: object
+    loaded_at: float = field(default_factory=time.time)
+    load_seconds: float = 0.0
+    legacy_mapper: object = None    # features.FeatureMapper applied by predict, see legacy_mapper()
+    # Grouping of the categories, only used to normalise the keys of the prediction cache
+    feature_mapper: object = None
+    compiled: CompiledPipeline = None
+
+    def predict(self, pricing):
+        """Predict prices of a DataFrame of raw car features."""
+        if self.legacy_mapper is not None:
+            with timed_stage('feature_mapping'):
+                pricing = self.legacy_mapper.transform(pricing)
+        with timed_stage('inference'):
+            return self.model.predict(pricing)
+
+    def predict_one(self, features):
+        """Predict the price of one car (dict of raw features), without pandas when compiled."""
+        if self.compiled is not None:
+            try:
+                with timed_stage('inference'):
+                    return self.compiled.predict_one(features)
+            except UnknownCategory:
+                pass
+        return self.predict(pd.DataFrame(features, index=[0])).tolist()[0]
+
+
+def pipeline_mapper(model):
+    """The "Mapping" step of the pipeline, None for models logged before it existed."""
+    try:
+        raw_model = model.get_raw_model()
+    except Exception:
+        raw_model = None
+    return getattr(raw_model, 'named_steps', {}).get('Mapping')
+
+
+def legacy_mapper(model):
+    """
+    Mapping to apply before calling models logged before the grouping of categories
+    became the "Mapping" step of the pipeline, None for the models that do it themselves.
+    """
+    if pipeline_mapper(model) is not None:
+        return None
+    from features import FeatureMapper, DEFAULT_MAPPING
+    return FeatureMapper(DEFAULT_MAPPING).fit()
+
+
+def set_model_threads(model, nthread):
+    """Number of threads used by the regressor of the pipeline (n_jobs of XGBoost or RandomForest)."""
+    try:
+        regressor = model.get_raw_model().named_steps['Regressor']
+    except Exception:
+        return
+    if 'n_jobs' in regressor.get_params():
+        regressor.set_params(n_jobs=nthread)
+
+
+def compile_fast_path(entry, parity_input=None):
+    """
+    Compiled single-car path of a loaded model, checked against the pandas path on
+    `parity_input`. None if the model is not a pipeline from train.py or differs.
+    """
+    try:
+        compiled = CompiledPipeline(entry.model.get_raw_model(), entry.legacy_mapper)
+        if parity_input is not None:
+            check_parity(compiled, entry, parity_input)
+    except Exception as e:
+        print(f'fast path disabled for model {entry.version}: {e}')
+        return None
+    return compiled
+
+
+class ModelCache:
+    """
+    Keeps MLflow models loaded once per process, keyed by model path and version.
+
+    Requests read `current` once and keep that reference until they are done, so a
+    reload only swaps the pointer: in-flight predictions finish on the model they
+    started with, new ones pick up the new model.
+    """
+
+    def __init__(self, tracking_uri, model_path, warmup_input=None, fast_path=False, nthread=None,
+                 serving_mode='mlflow'):
+        self.tracking_uri = tracking_uri
+        self.model_path = model_path
+        self.warmup_input = warmup_input
+        self.fast_path = fast_path
+        self.nthread = nthread
+        self.serving_mode = serving_mode
+        self._models = {}
+        self._current = None
+        self._load_lock = threading.Lock()
+        self._listeners = []
+        self.last_error = None
+
+    @property
+    def current(self):
+        return self._current
+
+    @property
+    def ready(self):
+        return self._current is not None
+
+    def on_swap(self, callback):
+        """Register `callback(entry)`, called each time a different model becomes the current one."""
+        self._listeners.append(callback)
+
+    def _load_onnx(self, model_path):
+        from onnx_model import load_onnx_model
+        # Threads of the session shared out like those of XGBoost (see executors.default_nthread)
+        model = load_onnx_model(model_path, self.tracking_uri, self.nthread)
+        # The ONNX runtime maps the categories itself, and predicts single cars without pandas
+        return LoadedModel(model_path=model_path, version=str(model.version), model=model,
+                           feature_mapper=model.mapper, compiled=model)
+
+    def _load(self, model_path):
+        start = time.perf_counter()
+        if self.serving_mode == 'onnx':
+            entry = self._load_onnx(model_path)
+            if self.warmup_input is not None:
+                entry.predict(self.warmup_input)
+            entry.load_seconds = time.perf_counter() - start
+            return entry
+
+        import mlflow
+        if self.tracking_uri:
+            mlflow.set_tracking_uri(self.tracking_uri)
+        model = mlflow.pyfunc.load_model(model_path)
+        version = model.metadata.run_id or model.metadata.model_uuid or model_path
+        entry = LoadedModel(model_path=model_path, version=str(version), model=model,
+                            legacy_mapper=legacy_mapper(model))
+        entry.feature_mapper = entry.legacy_mapper or pipeline_mapper(model)
+        if self.nthread:
+            set_model_threads(model, self.nthread)
+        if self.warmup_input is not None:
+            entry.predict(self.warmup_input)
+        if self.fast_path:
+            entry.compiled = compile_fast_path(entry, self.warmup_input)
+        entry.load_seconds = time.perf_counter() - start
+        return entry
+
+    def load(self, model_path=None, force=False):
+        """
+        Load (or reuse) the model at `model_path` and make it the current one.
+
+        The new model is fully loaded and warmed up before the swap, so a failing
+        reload leaves the previous model serving.
+        """
+        model_path = model_path or self.model_path
+        with self._load_lock:
+            entry = None if force else self._cached(model_path)
+            if entry is None:
+                try:
+                    entry = self._load(model_path)
+                except Exception as e:
+                    self.last_error = f"{type(e).__name__}: {e}"
+                    raise
+                # Only one version per path is kept: the previous one is dropped once
+                # the requests still holding it are done
+                self._models = {key: value for key, value in self._models.items()
+                                if value.model_path != model_path}
+                self._models[self._key(entry)] = entry
+            self.model_path = model_path
+            previous, self._current = self._current, entry
+            self.last_error = None
+        if previous is not None and previous is not entry:
+            for callback in self._listeners:
+                callback(entry)
+        return entry
+
+    def _cached(self, model_path):
+        for entry in self._models.values():
+            if entry.model_path == model_path:
+                return entry
+        return None
+
+    @staticmethod
+    def _key(entry):
+        return f"{entry.model_path}@{entry.version}"
@@ -0,0 +1,133 @@
+import os
+import json
+import numpy as np
+import onnxruntime as rt
+
+
+class DictMapper:
+    """Grouping of categories read from the ONNX metadata, same behaviour as features.FeatureMapper."""
+
+    def __init__(self, mapping):
+        self.mapping = mapping or {}
+
+    def map_value(self, col, value):
+        return self.mapping.get(col, {}).get(value, value)
+
+    def transform(self, pricing):
+        pricing = pricing.copy()
+        for col, changes in self.mapping.items():
+            if col in pricing.columns and changes:
+                pricing[col] = pricing[col].map(changes).fillna(pricing[col])
+        return pricing
+
+
+class DictCleaner:
+    """Cleaning rules read from the ONNX metadata, same behaviour as features.DataCleaner."""
+
+    def __init__(self, cleaning):
+        cleaning = cleaning or {}
+        self.ranges = cleaning.get('ranges', {})
+        self.rare_categories = {col: set(values) for col, values in cleaning.get('rare_categories', {}).items()}
+        self.fallbacks = cleaning.get('fallbacks', {})
+
+    def clean_value(self, col, value):
+        if col in self.ranges:
+            low, high = self.ranges[col]
+            return value if value is not None and low <= value <= high else np.nan
+        if value in self.rare_categories.get(col, ()):
+            return self.fallbacks[col]
+        return value
+
+    def transform(self, pricing):
+        pricing = pricing.copy()
+        for col, (low, high) in self.ranges.items():
+            if col in pricing.columns:
+                values = pricing[col].astype(float)
+                pricing[col] = values.where(values.between(low, high))
+        for col, rare in self.rare_categories.items():
+            if col in pricing.columns and rare:
+                pricing[col] = pricing[col].where(~pricing[col].isin(rare), self.fallbacks[col])
+        return pricing
+
+
+class OnnxModel:
+    """
+    Pipeline exported by train.py (see ml/export_onnx.py) run with onnxruntime: neither
+    scikit-learn nor XGBoost are needed to predict.
+
+    `directory` holds model.onnx and metadata.json (cleaning rules, grouping of categories,
+    known categories). `nthread` is the number of threads of the session, all the cores if None.
+    """
+
+    def __init__(self, directory, nthread=None):
+        with open(os.path.join(directory, 'metadata.json')) as f:
+            self.metadata = json.load(f)
+        self.version = self.metadata.get('run_id') or directory
+        self.cleaner = DictCleaner(self.metadata.get('cleaning'))
+        self.mapper = DictMapper(self.metadata.get('mapping'))
+        self.categories = {col: set(values) for col, values in self.metadata.get('categories', {}).items()}
+        self.numeric = self.metadata.get('numeric', {})
+        options = rt.SessionOptions()
+        options.intra_op_num_threads = nthread or 0
+        self.session = rt.InferenceSession(os.path.join(directory, 'model.onnx'), options,
+                                           providers=['CPUExecutionProvider'])
+        self.inputs = {}
+        for model_input in self.session.get_inputs():
+            if model_input.type == 'tensor(string)':
+                self.inputs[model_input.name] = object
+            elif model_input.type == 'tensor(int64)':
+                self.inputs[model_input.name] = np.int64
+            else:
+                self.inputs[model_input.name] = np.float32
+
+    def _check_categories(self, col, values):
+        known = self.categories.get(col)
+        if known is not None:
+            unknown = set(values) - known
+            if unknown:
+                raise ValueError(f"Found unknown categories {sorted(unknown)} in column {col}")
+
+    def _scale(self, col, values):
+        """Imputation and scaling of a numeric feature, in double precision before the cast to float."""
+        scaling = self.numeric.get(col)
+        if scaling is None:
+            return values
+        values = np.asarray(values, dtype=np.float64)
+        values = np.where(np.isnan(values), scaling['fill'], values)
+        return (values - scaling['mean']) / scaling['scale']
+
+    def predict(self, pricing):
+        """Predict prices of a DataFrame of raw car features."""
+        pricing = self.mapper.transform(self.cleaner.transform(pricing))
+        feeds = {}
+        for col, dtype in self.inputs.items():
+            values = pricing[col].to_numpy()
+            if dtype is object:
+                self._check_categories(col, values)
+            elif dtype is np.float32:
+                values = self._scale(col, values)
+            feeds[col] = values.astype(dtype).reshape(-1, 1)
+        return self.session.run(None, feeds)[0].ravel()
+
+    def predict_one(self, features):
+        """Predict the price of one car (dict of raw features)."""
+        feeds = {}
+        for col, dtype in self.inputs.items():
+            value = self.cleaner.clean_value(col, features[col])
+            if dtype is object:
+                value = self.mapper.map_value(col, value)
+                self._check_categories(col, [value])
+            elif dtype is np.float32:
+                value = self._scale(col, [np.nan if value is None else value])
+            feeds[col] = np.array(value, dtype=dtype).reshape(1, 1)
+        return float(self.session.run(None, feeds)[0][0, 0])
+
+
+def load_onnx_model(model_path, tracking_uri=None, nthread=None):
+    """OnnxModel from a local directory, or from MLflow artifacts (e.g. runs:/<run_id>/Getaround_PredictPricing_onnx)."""
+    if not os.path.isdir(model_path):
+        import mlflow
+        if tracking_uri:
+            mlflow.set_tracking_uri(tracking_uri)
+        model_path = mlflow.artifacts.download_artifacts(model_path)
+    return OnnxModel(model_path, nthread)
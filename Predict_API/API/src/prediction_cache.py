@@ -0,0 +1,124 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import registry
+
+cache_requests = registry.counter(
+    "getaround_prediction_cache_requests_total", "Lookups in the prediction cache", ["result"])
+cache_evictions = registry.counter(
+    "getaround_prediction_cache_evictions_total", "Predictions removed from the in-memory cache", ["reason"])
+cache_size = registry.gauge(
+    "getaround_prediction_cache_size", "Number of predictions held by the in-memory cache")
+
+
+class CacheBackend:
+    """Interface of the stores behind PredictionCache."""
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def set(self, key, value):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+
+class InMemoryCache(CacheBackend):
+    """LRU cache of at most `max_size` predictions, each kept `ttl` seconds (forever if None)."""
+
+    def __init__(self, max_size=10000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            value, expires_at = item
+            if expires_at is not None and expires_at < time.monotonic():
+                del self._items[key]
+                cache_evictions.inc(reason="expired")
+                cache_size.set(len(self._items))
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            self._items[key] = (value, expires_at)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                cache_evictions.inc(reason="size")
+            cache_size.set(len(self._items))
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            cache_size.set(0)
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache shared by all the API workers, in any server speaking the Redis protocol.
+    Size is bounded by the server (e.g. `maxmemory-policy allkeys-lru`), entries expire after `ttl`.
+    """
+
+    def __init__(self, url, ttl=None, prefix="getaround:prediction:"):
+        try:
+            import redis
+        except ImportError:
+            raise ImportError("PREDICTION_CACHE=redis needs the redis package: pip install redis")
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return None if value is None else float(value)
+
+    def set(self, key, value):
+        self.client.set(self.prefix + key, value, ex=int(self.ttl) if self.ttl else None)
+
+    def clear(self):
+        keys = list(self.client.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.client.delete(*keys)
+
+
+class PredictionCache:
+    """
+    Predictions already made, keyed on the grouped features of the car and the model version:
+    the same configuration asked again is answered without calling the model.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    @staticmethod
+    def key(entry, features):
+        mapper = entry.feature_mapper
+        if mapper is not None:
+            features = {name: mapper.map_value(name, value) for name, value in features.items()}
+        canonical = json.dumps([entry.version, sorted(features.items())], default=str)
+        return hashlib.sha1(canonical.encode()).hexdigest()
+
+    def get(self, key):
+        value = self.backend.get(key)
+        cache_requests.inc(result="miss" if value is None else "hit")
+        return value
+
+    def set(self, key, value):
+        self.backend.set(key, value)
+
+    def invalidate(self, entry=None):
+        """Called when a model is swapped in: predictions of the previous one are dropped."""
+        self.backend.clear()
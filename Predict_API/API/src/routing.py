@@ -0,0 +1,155 @@
+import hashlib
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from metrics import registry
+from instrumentation import LATENCY_BUCKETS
+
+MAIN_MODEL = 'main'
+DELTA_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 200)
+
+model_predictions = registry.counter(
+    "getaround_model_predictions_total", "Cars scored by each resident model, served or in shadow",
+    ["model", "role"])
+model_seconds = registry.histogram(
+    "getaround_model_inference_seconds", "Time taken by each model to score a request, served or in shadow",
+    LATENCY_BUCKETS, ["model", "role"])
+shadow_deltas = registry.histogram(
+    "getaround_shadow_delta", "Absolute difference, per car, between the price predicted by the shadow "
+    "model and the price served", DELTA_BUCKETS, ["model", "shadow"])
+shadow_dropped = registry.counter(
+    "getaround_shadow_dropped_total", "Requests not scored by the shadow model because too many were pending",
+    ["shadow"])
+
+
+class UnknownModel(KeyError):
+    """A request asked for a model that is not one of the routes."""
+
+
+def parse_routes(value):
+    """
+    Routes of MODEL_ROUTES, a JSON object like {"main": {"weight": 0.9}, "rf": {"model_path":
+    "runs:/<run_id>/Getaround_PredictPricing", "weight": 0.1}}: {name: (model_path, weight)}.
+    The main model is the one of MODEL_PATH (model_path None), with a weight of 1 if not given.
+    """
+    routes = {MAIN_MODEL: (None, 1.0)}
+    for name, route in json.loads(value or '{}').items():
+        if name != MAIN_MODEL and not route.get('model_path'):
+            raise ValueError(f"Route {name!r} of MODEL_ROUTES has no model_path")
+        routes[name] = (route.get('model_path') if name != MAIN_MODEL else None, float(route.get('weight', 0)))
+    return routes
+
+
+class ModelRouter:
+    """
+    Several models resident at once, each in its own ModelCache (loaded and reloaded on its own),
+    and the choice of the model serving each request:
+
+    - the model asked for by name (X-Model header)
+    - otherwise one drawn according to the weights of the loaded models, relative to each other
+      (a model of weight 0 is only served on demand). Requests with the same routing key
+      (X-Routing-Key header, e.g. a user id) are always served by the same model
+
+    The `shadow` model scores the requests too, but in its own thread once they are answered: its
+    predictions are only compared to the ones served. At most `shadow_max_pending` requests wait
+    for it, the next ones are not scored in shadow.
+    """
+
+    def __init__(self, caches, weights, shadow=None, shadow_max_pending=100):
+        for name in list(weights) + ([shadow] if shadow else []):
+            if name not in caches:
+                raise UnknownModel(name)
+        self.caches = caches
+        self.weights = weights
+        self.shadow = shadow
+        self.shadow_max_pending = shadow_max_pending
+        self._pending = 0
+        self._lock = threading.Lock()
+        self._shadow_pool = None
+
+    def start(self):
+        if self.shadow is not None:
+            self._shadow_pool = ThreadPoolExecutor(1, thread_name_prefix='shadow')
+
+    def shutdown(self):
+        if self._shadow_pool is not None:
+            self._shadow_pool.shutdown(wait=False)
+            self._shadow_pool = None
+
+    def choose(self, requested=None, routing_key=None):
+        """Name of the model serving a request, the main model when none of the others is loaded."""
+        if requested:
+            if requested not in self.caches:
+                raise UnknownModel(requested)
+            return requested
+        loaded = [(name, weight) for name, weight in self.weights.items()
+                  if weight > 0 and self.caches[name].ready]
+        total = sum(weight for _, weight in loaded)
+        if not total:
+            return MAIN_MODEL
+        if routing_key is not None:
+            digest = hashlib.sha1(str(routing_key).encode()).digest()
+            draw = int.from_bytes(digest[:8], 'big') / 2 ** 64 * total
+        else:
+            draw = random.random() * total
+        for name, weight in loaded:
+            draw -= weight
+            if draw < 0:
+                return name
+        return loaded[-1][0]
+
+    @staticmethod
+    def served(name, seconds, cars=1):
+        model_predictions.inc(cars, model=name, role='served')
+        model_seconds.observe(seconds, model=name, role='served')
+
+    def run_shadow(self, function, payload, served_name, served_predictions):
+        """
+        Score `payload` with `function(entry, payload)` and the shadow model, without waiting, and
+        record its differences with `served_predictions`. Nothing is done when the request was
+        served by the shadow model itself or when it is not loaded.
+        """
+        if self._shadow_pool is None or served_name == self.shadow:
+            return
+        entry = self.caches[self.shadow].current
+        if entry is None:
+            return
+        with self._lock:
+            if self._pending >= self.shadow_max_pending:
+                shadow_dropped.inc(shadow=self.shadow)
+                return
+            self._pending += 1
+        self._shadow_pool.submit(self._score_shadow, entry, function, payload, served_name, served_predictions)
+
+    def _score_shadow(self, entry, function, payload, served_name, served_predictions):
+        try:
+            start = time.perf_counter()
+            predictions = np.atleast_1d(np.asarray(function(entry, payload), dtype=float))
+            model_seconds.observe(time.perf_counter() - start, model=self.shadow, role='shadow')
+            model_predictions.inc(predictions.shape[0], model=self.shadow, role='shadow')
+            served = np.atleast_1d(np.asarray(served_predictions, dtype=float))
+            for delta in np.abs(predictions - served):
+                shadow_deltas.observe(float(delta), model=served_name, shadow=self.shadow)
+        except Exception as e:
+            print(f'shadow prediction of model {self.shadow} failed: {e}')
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def describe(self):
+        """Routes, weights and the model currently loaded by each of them."""
+        models = {}
+        for name, cache in self.caches.items():
+            entry = cache.current
+            models[name] = {
+                "weight": self.weights.get(name, 0.0), "shadow": name == self.shadow,
+                "model_path": entry.model_path if entry is not None else cache.model_path,
+                "model_version": entry.version if entry is not None else None,
+                "status": "ready" if entry is not None else "loading", "error": cache.last_error,
+            }
+        return models
@@ -0,0 +1,90 @@
+import argparse
+import json
+import os
+import re
+import subprocess
+import sys
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src')
+
+# Packages that the API should only import when the serving mode needs them
+HEAVY_PACKAGES = ('mlflow', 'sklearn', 'xgboost', 'onnxruntime', 'scipy', 'redis')
+
+READY_SCRIPT = """
+import json, time
+from fastapi.testclient import TestClient
+import app
+with TestClient(app.app) as client:
+    while client.get('/ready').status_code != 200 and app.model_cache.last_error is None:
+        time.sleep(0.01)
+    print(json.dumps({phase: app.startup_seconds.get(phase=phase) for phase in ('import', 'model_load', 'ready')}))
+"""
+
+
+#### Startup time of the API: time spent importing each module (python -X importtime) and, with
+#### --ready, time until the first model is loaded and /ready answers. Run it with the options
+#### of the container to check what a serving mode imports, e.g.:
+####   python startup_profile.py --env MODEL_PATH=model SERVING_MODE=onnx --ready
+
+def import_times(env):
+    """(module, depth, self seconds, cumulative seconds) of each module imported by `import app`."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=SRC_PATH, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"import app failed:\n{result.stderr}")
+    modules = []
+    for line in result.stderr.splitlines():
+        match = re.match(r'import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if match:
+            own, cumulative, indent, name = match.groups()
+            modules.append((name, (len(indent) - 1) // 2, int(own) / 1e6, int(cumulative) / 1e6))
+    return modules
+
+
+def ready_times(env):
+    """getaround_startup_seconds of the API started in a new process, once its model is loaded."""
+    result = subprocess.run([sys.executable, '-c', READY_SCRIPT], cwd=SRC_PATH, env=env,
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"API startup failed:\n{result.stderr}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def report(modules, top):
+    total = next(cumulative for name, depth, _, cumulative in modules if name == 'app' and depth == 0)
+    print(f"import app: {total:.3f}s")
+    print("\nslowest imports (cumulative):")
+    # Modules imported by app and the first modules of each package, heaviest first
+    direct = sorted([module for module in modules if module[1] == 1], key=lambda module: -module[3])
+    for name, _, _, cumulative in direct[:top]:
+        print(f"  {name:<40} {cumulative:8.3f}s  {cumulative / total:6.1%}")
+    imported = {name.split('.')[0] for name, _, _, _ in modules}
+    heavy = [package for package in HEAVY_PACKAGES if package in imported]
+    print(f"\nheavy packages imported at startup: {', '.join(heavy) or 'none'}")
+    return {'import_seconds': total, 'heavy_packages': heavy,
+            'modules': {name: cumulative for name, _, _, cumulative in direct[:top]}}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--env", nargs="*", default=[], help="options of the API, e.g. SERVING_MODE=onnx")
+    parser.add_argument("--top", type=int, default=15, help="number of imports listed")
+    parser.add_argument("--ready", action="store_true", help="also start the API and time the loading of the model")
+    parser.add_argument("--output", help="save the results to this JSON file")
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    for option in args.env:
+        name, value = option.split('=', 1)
+        env[name] = value
+    # The model path is read at import: any value will do to time the imports alone
+    env.setdefault('MODEL_PATH', 'model')
+
+    results = report(import_times(env), args.top)
+    if args.ready:
+        results['startup_seconds'] = ready_times(env)
+        for phase, seconds in results['startup_seconds'].items():
+            print(f"{phase:<12} {seconds:8.3f}s")
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
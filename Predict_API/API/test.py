@@ -1,26 +1,23 @@
+import os
+import sys
 import requests 
 import json
 import pandas as pd 
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'src'))
+# After src: the app module imported is the API, not the dashboard
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Streamlit_Dashboard'))
+from datastore import load
+
 
 #### Test ML Model 
 
 def test_prediction():
 
-    df = pd.read_csv('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv')
+    df = load('pricing', categorical=False)
     df = df.iloc[:,1:].sample(1)
 
-    dict_changes = {}
-    dict_changes['model_key'] = {'Fiat': 'low_price', 'Mazda': 'low_price', 'Ford': 'low_price', 'Mercedes': 'low_price',
-                                    'Porsche': 'medium_price', 'Honda': 'medium_price', 'Yamaha': 'medium_price', 
-                                    'Lamborghini': 'medium_price', 'Alfa Romeo': 'medium_price', 'KIA Motors': 'medium_price', 
-                                    'Opel': 'medium_price',
-                                    'Suzuki': 'high_price', 'Mini': 'high_price', 'Lexus': 'high_price', 'Maserati': 'high_price'
-                                    }
-    dict_changes['fuel'] = {'hybrid_petrol': 'high_price', 'electro': 'high_price'}
-    dict_changes['paint_color'] = {'orange': 'high_price', 'white': 'high_price'}
-    for col in dict_changes.keys():
-        df = df.replace({col: dict_changes[col]})
+    # Grouping of rare categories is done by the API itself
     print(df)
 
     values = []
@@ -37,5 +34,273 @@ def test_prediction():
 
     print('response: ', response, response.content)
 
+
+
+#### Test fast inference path (FAST_INFERENCE=true) against the pandas path
+
+def test_fast_path_parity():
+
+    from model_cache import ModelCache
+    from fast_path import CompiledPipeline, UnknownCategory, check_parity
+
+    model_cache = ModelCache(os.environ.get('MLOPS_SERVER_URI'), os.environ['MODEL_PATH'])
+    entry = model_cache.load()
+    compiled = CompiledPipeline(entry.model.get_raw_model(), entry.legacy_mapper)
+
+    df = load('pricing', categorical=False)
+    df = df.iloc[:,1:].drop('rental_price_per_day', axis=1)
+    df = df.astype({'mileage': float, 'engine_power': float})
+
+    # Rare categories are replaced by the Cleaning step of the model, only models logged without
+    # it (wo10Cats before the Cleaning step) cannot score the categories dropped from training
+    def is_known(row):
+        try:
+            compiled.encode(row)
+            return True
+        except UnknownCategory:
+            return False
+    df = df.loc[[is_known(row) for row in df.to_dict(orient='records')], :]
+
+    # Every car of the dataset, plus missing values for the numeric features
+    missing = df.sample(100, random_state=0).assign(mileage=float('nan'), engine_power=float('nan'))
+    max_difference = check_parity(compiled, entry, pd.concat([df, missing], ignore_index=True))
+    print('fast path parity OK, max difference: ', max_difference)
+
+
+#### Test file upload: blank cells are rejected like by /predict, not scored as made up cars
+
+def test_upload_missing_values():
+
+    import time
+    from fastapi.testclient import TestClient
+    import app
+
+    df = load('pricing', categorical=False)
+    df = df.iloc[:5, 1:].drop('rental_price_per_day', axis=1)
+    df = df.astype({'has_gps': object, 'model_key': object})
+    df.loc[1, 'has_gps'] = None
+    df.loc[3, 'model_key'] = None
+
+    with TestClient(app.app) as client:
+        while client.get('/ready').status_code != 200:
+            time.sleep(0.1)
+        response = client.post('/predict/batch/file', files={'file': ('cars.csv', df.to_csv(index=False))})
+        assert response.status_code == 422, response.content
+        detail = response.json()['detail']
+        assert 'has_gps (rows [1])' in detail and 'model_key (rows [3])' in detail, detail
+        response = client.post('/predict/batch/file', files={'file': ('cars.csv', df.dropna().to_csv(index=False))})
+        assert response.status_code == 200 and len(response.json()['predictions']) == 3, response.content
+    print('upload missing values OK')
+
+
+#### Test cleaning rules against the ones of the first train.py (engine power of 0 or above 400)
+
+def test_cleaning_rules():
+
+    import numpy as np
+    from features import DataCleaner, VALID_RANGES
+
+    df = load('pricing', categorical=False)
+    cleaner = DataCleaner(VALID_RANGES).fit(df)
+    cleaned = cleaner.transform(df)
+    baseline = (df['engine_power'] == 0) | (df['engine_power'] > 400)
+    assert (cleaned['engine_power'].isna() == baseline).all()
+    baseline = (df['mileage'] < 0) | (df['mileage'] > 1000000)
+    assert (cleaned['mileage'].isna() == baseline).all()
+
+    # Bounds included, negative and fractional engine powers below 1 replaced too
+    powers = pd.DataFrame({'engine_power': [-5, 0, 0.5, 1, 400, 401]})
+    assert cleaner.transform(powers)['engine_power'].isna().tolist() == [True, True, True, False, False, True]
+    assert [np.isnan(cleaner.clean_value('engine_power', value)) for value in (-5, 0, 1, 400, 401)] == \
+        [True, True, False, False, True]
+    print('cleaning rules OK')
+
+
+#### Test micro-batching: an invalid car only fails its own request
+
+def test_micro_batching_isolation():
+
+    import asyncio
+    from batching import MicroBatcher
+
+    async def predict_rows(rows):
+        if any(row['model_key'] not in ('Citroën', 'Renault') for row in rows):
+            raise ValueError("Unknown category")
+        return [len(row['model_key']) for row in rows]
+
+    async def run():
+        batcher = MicroBatcher(predict_rows, max_batch_size=64, max_wait_ms=50)
+        batcher.start()
+        rows = [{'model_key': 'Citroën'}] * 5 + [{'model_key': 'Unknown'}]
+        results = await asyncio.gather(*(batcher.predict(row) for row in rows), return_exceptions=True)
+        await batcher.stop()
+        return results
+
+    results = asyncio.run(run())
+    assert results[:5] == [7] * 5, results
+    assert isinstance(results[5], ValueError), results
+    print('micro-batching isolation OK')
+
+
+
+#### Test threshold sweeps against the loop of the dashboard, one threshold at a time
+
+def sweep_loop(delay, chains, pricing, threshold, checkin_type):
+    """Metrics of one threshold and type of checkin, computed like the dashboard did before thresholds.py."""
+    import numpy as np
+    chains = chains.assign(threshold=np.where(chains['time_delta_with_previous_rental_in_minutes'] <= threshold,
+                                              'below_threshold', 'above_threshold'))
+    scope = delay if checkin_type == 'both' else delay.loc[delay['checkin_type'] == checkin_type, :]
+    scope_chains = chains if checkin_type == 'both' else chains.loc[chains['checkin_type'] == checkin_type, :]
+    below = (scope['time_delta_with_previous_rental_in_minutes'] <= threshold).sum()
+
+    late = scope_chains.loc[scope_chains['type_of_delay'] == 'late', :]
+    canceled = late.loc[late['state'] == 'canceled', :]
+    share_problems_solved = (canceled['threshold'] == 'below_threshold').sum() / canceled.shape[0] * 100
+
+    in_scope = pricing if checkin_type == 'both' else \
+        pricing.loc[pricing['has_getaround_connect'] == (checkin_type == 'connect'), :]
+    percentage_affected = 1 - below / scope.shape[0]
+    pricing_affected = in_scope.sample(int(round(percentage_affected * in_scope.shape[0], 0)), random_state=10)
+    price_affected = np.mean(in_scope['rental_price_per_day']) - np.mean(pricing_affected['rental_price_per_day'])
+    rentals_affected = (scope_chains['threshold'] == 'below_threshold').sum() / scope_chains.shape[0]
+    current_prices = sum(pricing['rental_price_per_day'])
+    scope_prices = sum(in_scope['rental_price_per_day'])
+    affected_prices = scope_prices * (1 - rentals_affected) * (1 - price_affected) + scope_prices * rentals_affected \
+        + current_prices - scope_prices
+    return {
+        'share_rentals_lost': below / delay.shape[0] * 100,
+        'share_problems_solved': share_problems_solved,
+        'price_affected': price_affected,
+        'rentals_affected': rentals_affected,
+        'total_loss': current_prices - affected_prices,
+        'percent_loss': (current_prices - affected_prices) / current_prices * 100,
+    }
+
+
+def test_threshold_sweeps_parity():
+
+    from rentals import rental_chains, delayed_chains
+    from thresholds import threshold_sweeps
+
+    delay = load('delay')
+    pricing = load('pricing')
+    chains = delayed_chains(rental_chains(delay))
+    thresholds = [0, 30, 60, 120, 360, 719]
+    sweeps = threshold_sweeps(delay, chains, pricing, thresholds)
+    for checkin_type, sweep in sweeps.items():
+        for threshold in thresholds:
+            expected = sweep_loop(delay, chains, pricing, threshold, checkin_type)
+            for metric, value in expected.items():
+                assert abs(sweep.loc[threshold, metric] - value) <= 1e-9 * max(1, abs(value)), \
+                    (checkin_type, threshold, metric, sweep.loc[threshold, metric], value)
+    print('threshold sweeps parity OK')
+
+
+#### Test aggregates of the dashboard charts against the pandas counts the charts used to be drawn from
+
+def test_dashboard_aggregates_parity():
+
+    import numpy as np
+    from rentals import rental_chains, delayed_chains
+    from aggregates import grouped_counts, ecdf_table, binned_histogram, ThresholdCounts
+
+    delay = load('delay')
+    pricing = load('pricing')
+    chains = delayed_chains(rental_chains(delay))
+
+    # Question 1: pie of the types of delay, histogram of the states
+    counts = grouped_counts(chains, ['type_of_delay']).set_index('type_of_delay')['count']
+    assert counts.to_dict() == chains['type_of_delay'].value_counts().to_dict()
+    columns = ['state', 'checkin_type', 'type_of_delay']
+    counts = grouped_counts(chains, columns).set_index(columns)['count']
+    assert counts.to_dict() == chains.groupby(columns, observed=True).size().to_dict()
+
+    # ECDFs: each point is the exact share of the rentals of its state at or below its value
+    for checkin_type in ('both', 'mobile', 'connect'):
+        scope = chains if checkin_type == 'both' else chains.loc[chains['checkin_type'] == checkin_type, :]
+        ecdf = ecdf_table(scope, 'timedelta_minus_delay', by='state')
+        for state, points in ecdf.groupby('state'):
+            values = scope.loc[scope['state'] == state, 'timedelta_minus_delay']
+            expected = [(values <= value).mean() for value in points['timedelta_minus_delay']]
+            assert np.allclose(points['probability'], expected), (checkin_type, state)
+            assert points['probability'].iloc[-1] == 1
+
+    # Question 3: late arrivals below and above the threshold
+    late = chains.loc[chains['type_of_delay'] == 'late', :]
+    threshold_counts = ThresholdCounts(late, ['state', 'checkin_type'])
+    for threshold in (0, 360, 719):
+        for checkin_type in ('both', 'mobile', 'connect'):
+            scope = late if checkin_type == 'both' else late.loc[late['checkin_type'] == checkin_type, :]
+            scope = scope.assign(threshold=scope['time_delta_with_previous_rental_in_minutes']
+                                 .apply(lambda x: 'below_threshold' if x <= threshold else 'above_threshold'))
+            expected = scope.groupby(['state', 'checkin_type', 'threshold'], observed=True).size().to_dict()
+            counts = threshold_counts.counts(threshold, where=None if checkin_type == 'both' else
+                                             {'checkin_type': checkin_type})
+            assert counts.set_index(['state', 'checkin_type', 'threshold'])['count'].to_dict() == expected, \
+                (threshold, checkin_type)
+
+    # Question 4: every car in one bin of the price histogram
+    prices = binned_histogram(pricing.astype({'has_getaround_connect': str}), 'rental_price_per_day',
+                              by='has_getaround_connect')
+    assert prices.groupby('has_getaround_connect')['count'].sum().to_dict() == \
+        pricing['has_getaround_connect'].astype(str).value_counts().to_dict()
+    print('dashboard aggregates parity OK')
+
+
+#### Test rental store: ingestion by chunks, one of them interrupted, against the whole delay analysis
+
+def test_rental_store_ingestion():
+
+    import tempfile
+    from ingestion import RentalStore
+    from rentals import rental_chains, delayed_chains
+    from thresholds import threshold_sweeps
+
+    delay = load('delay')
+    pricing = load('pricing')
+    # Shuffled, so that chains are stored before their previous rental
+    shuffled = delay.sample(frac=1, random_state=0)
+    size = -(-shuffled.shape[0] // 6)
+    chunks = [shuffled.iloc[start:start + size] for start in range(0, shuffled.shape[0], size)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = RentalStore(directory)
+        for number, chunk in enumerate(chunks):
+            if number == len(chunks) // 2:
+                # Crash just before the rentals of the chunk are written, then ingested again
+                write = store._write
+                def crash(table, data, number):
+                    if table == 'rentals':
+                        raise OSError("interrupted")
+                    write(table, data, number)
+                store._write = crash
+                try:
+                    store.append(chunk)
+                except OSError:
+                    pass
+                store._write = write
+                store = RentalStore(directory)
+            store.append(chunk)
+
+        expected = rental_chains(delay).sort_values('rental_id').reset_index(drop=True)
+        chains = store.chains()
+        assert chains.shape[0] == expected.shape[0], (chains.shape[0], expected.shape[0])
+        pd.testing.assert_series_equal(chains['previous_delay_at_checkout'], expected['previous_delay_at_checkout'],
+                                       check_dtype=False)
+        expected_sweeps = threshold_sweeps(delay, delayed_chains(expected), pricing)
+        for checkin_type, sweep in store.sweeps(pricing).items():
+            pd.testing.assert_frame_equal(sweep, expected_sweeps[checkin_type], check_dtype=False)
+    print('rental store ingestion OK')
+
+
+test_cleaning_rules()
+test_threshold_sweeps_parity()
+test_dashboard_aggregates_parity()
+test_rental_store_ingestion()
+test_micro_batching_isolation()
 test_prediction()
+if os.environ.get('MODEL_PATH'):
+    test_fast_path_parity()
+    test_upload_missing_values()
 
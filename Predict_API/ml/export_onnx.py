@@ -0,0 +1,154 @@
+import os
+import copy
+import json
+import tempfile
+import numpy as np
+import mlflow
+import onnx
+from onnx import helper, compose, TensorProto
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType, StringTensorType, Int64TensorType
+from onnxmltools import convert_xgboost
+from sklearn.preprocessing import OneHotEncoder
+
+# Runtime and compiled layout of the API, its sources are put on sys.path by train.py
+from onnx_model import OnnxModel
+from fast_path import CompiledPipeline
+
+ONNX_ARTIFACT_PATH = "Getaround_PredictPricing_onnx"
+TARGET_OPSET = 15
+
+
+def input_types(X):
+    """One ONNX input per column: strings, booleans given as 0/1 integers, and floats."""
+    types = []
+    for col in X.columns:
+        if X[col].dtype == object:
+            types.append((col, StringTensorType([None, 1])))
+        elif X[col].dtype == bool:
+            types.append((col, Int64TensorType([None, 1])))
+        else:
+            types.append((col, FloatTensorType([None, 1])))
+    return types
+
+
+def passthrough_numeric(preprocessor):
+    """
+    Copy of the fitted ColumnTransformer where the numeric features pass through. They are
+    imputed and scaled by the runtime in double precision like scikit-learn (see onnx_metadata):
+    in float, a value close to a split threshold of the trees can fall on the other side of it.
+    """
+    preprocessor = copy.deepcopy(preprocessor)
+    preprocessor.transformers_ = [
+        (name, transformer if isinstance(transformer, OneHotEncoder) or transformer == 'drop' else 'passthrough', columns)
+        for name, transformer, columns in preprocessor.transformers_]
+    return preprocessor
+
+
+def to_float_graph(input_type, n_inputs, zeros_as_missing):
+    """
+    Casts the preprocessed features to float, as the regressors do. With `zeros_as_missing`,
+    zeros are also replaced by NaN, the way XGBoost reads the sparse matrices of ColumnTransformer.
+    """
+    nodes = [helper.make_node('Cast', ['dense'], ['floats'], to=TensorProto.FLOAT)]
+    if zeros_as_missing:
+        nodes += [
+            helper.make_node('Constant', [], ['zero'], value=helper.make_tensor('zero_value', TensorProto.FLOAT, [], [0.0])),
+            helper.make_node('Constant', [], ['nan'], value=helper.make_tensor('nan_value', TensorProto.FLOAT, [], [np.nan])),
+            helper.make_node('Equal', ['floats', 'zero'], ['is_zero']),
+            helper.make_node('Where', ['is_zero', 'nan', 'floats'], ['features'])]
+    else:
+        nodes += [helper.make_node('Identity', ['floats'], ['features'])]
+    graph = helper.make_graph(
+        nodes, 'to_float',
+        [helper.make_tensor_value_info('dense', input_type, [None, n_inputs])],
+        [helper.make_tensor_value_info('features', TensorProto.FLOAT, [None, n_inputs])])
+    return helper.make_model(graph)
+
+
+def align_opsets(models):
+    """merge_models needs the same operator sets everywhere: the highest version of each domain."""
+    versions = {}
+    for model in models:
+        for opset in model.opset_import:
+            versions[opset.domain] = max(versions.get(opset.domain, 0), opset.version)
+    for model in models:
+        model.ir_version = models[0].ir_version
+        del model.opset_import[:]
+        model.opset_import.extend([helper.make_opsetid(domain, version) for domain, version in versions.items()])
+
+
+def export_onnx(pipeline, X):
+    """
+    ONNX graph of the "Preprocessing" and "Regressor" steps of a train.py pipeline, taking the
+    (already mapped) features of X as inputs. The "Mapping" step is applied by the runtime.
+    """
+    preprocessor = pipeline.named_steps['Preprocessing']
+    regressor = pipeline.named_steps['Regressor']
+    preprocessing = convert_sklearn(passthrough_numeric(preprocessor), initial_types=input_types(X),
+                                    target_opset=TARGET_OPSET)
+    n_inputs = preprocessor.transform(pipeline.named_steps['Mapping'].transform(X.head(1))).shape[1]
+
+    regressor_types = [('inputs', FloatTensorType([None, n_inputs]))]
+    is_xgboost = type(regressor).__module__.startswith('xgboost')
+    if is_xgboost:
+        regression = convert_xgboost(regressor, initial_types=regressor_types, target_opset=TARGET_OPSET)
+    else:
+        regression = convert_sklearn(regressor, initial_types=regressor_types, target_opset=TARGET_OPSET)
+
+    zeros_as_missing = is_xgboost and getattr(preprocessor, 'sparse_output_', False)
+    output_type = preprocessing.graph.output[0].type.tensor_type.elem_type
+    models = [preprocessing, to_float_graph(output_type, n_inputs, zeros_as_missing), regression]
+    align_opsets(models)
+
+    # Steps are prefixed so that the names of their nodes can not collide
+    merged, output = models[0], preprocessing.graph.output[0].name
+    for i, model in enumerate(models[1:]):
+        model = compose.add_prefix(model, f'step{i+1}_')
+        merged = compose.merge_models(merged, model, io_map=[(output, model.graph.input[0].name)])
+        output = model.graph.output[0].name
+    return merged
+
+
+def onnx_metadata(pipeline, X, run_id):
+    """
+    What the runtime needs besides the graph: cleaning rules, grouping of categories, known
+    categories, and imputation value, mean and scale of the numeric features.
+    """
+    cleaner = pipeline.named_steps.get('Cleaning')
+    encoder = pipeline.named_steps['Preprocessing'].named_transformers_['cat']
+    categorical = [col for col in X.columns if X[col].dtype == object]
+    categories = {col: [str(value) for value in values]
+                  for col, values in zip(encoder.feature_names_in_, encoder.categories_) if col in categorical}
+    numeric = {feature: {'fill': float(fill), 'mean': float(mean), 'scale': float(scale)}
+               for feature, _, fill, mean, scale in CompiledPipeline(pipeline).numeric}
+    return {
+        'run_id': run_id,
+        'cleaning': cleaner.to_dict() if cleaner is not None else {},
+        'mapping': pipeline.named_steps['Mapping'].mapping or {},
+        'categories': categories,
+        'numeric': numeric,
+        'columns': list(X.columns),
+    }
+
+
+def log_onnx_model(pipeline, X_train, X_test, run_id, max_difference=1e-3):
+    """
+    Export the pipeline to ONNX, check it predicts like the sklearn pipeline on X_test,
+    and log the graph and its metadata as artifacts of the run.
+    """
+    model = export_onnx(pipeline, X_train)
+    metadata = onnx_metadata(pipeline, X_train, run_id)
+    with tempfile.TemporaryDirectory() as directory:
+        onnx.save(model, os.path.join(directory, 'model.onnx'))
+        with open(os.path.join(directory, 'metadata.json'), 'w') as f:
+            json.dump(metadata, f)
+
+        onnx_predictions = OnnxModel(directory).predict(X_test)
+        difference = float(np.max(np.abs(onnx_predictions - pipeline.predict(X_test))))
+        mlflow.log_metric('onnx_max_abs_difference', difference)
+        if difference > max_difference * max(1.0, float(np.max(np.abs(onnx_predictions)))):
+            print(f"ONNX export not logged: predictions differ by up to {difference}")
+            return None
+        mlflow.log_artifacts(directory, artifact_path=ONNX_ARTIFACT_PATH)
+    return difference
@@ -0,0 +1,223 @@
+import os
+import numpy as np
+import pandas as pd
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import xgboost as xgb
+from sklearn.pipeline import Pipeline
+
+
+#### Training on a pricing dataset too large to be loaded at once (see train.py --out-of-core).
+#### The file is read by chunks several times: once to count the categories of the cleaning step,
+#### once for the statistics of the scaler and the encoder, then by XGBoost, which builds its
+#### quantized matrix from the chunks in external memory, and a last time to evaluate the model.
+
+# Share of the memory ceiling given to one chunk: it is copied by the cleaning and the encoding
+CHUNK_MEMORY_SHARE = 0.05
+
+
+def read_chunks(path, chunksize):
+    """DataFrames of `chunksize` rows of a Parquet, Arrow (Feather, like datastore.py) or CSV file."""
+    if path.endswith('.parquet'):
+        batches = pq.ParquetFile(path).iter_batches(chunksize)
+    elif path.endswith('.arrow') or path.endswith('.feather'):
+        # Memory-mapped: the rows of a chunk are only read when it is converted
+        batches = feather.read_table(path, memory_map=True).to_batches(chunksize)
+    else:
+        batches = pd.read_csv(path, chunksize=chunksize)
+    for batch in batches:
+        chunk = batch if isinstance(batch, pd.DataFrame) else batch.to_pandas()
+        chunk = chunk.drop(columns='Unnamed: 0', errors='ignore')
+        yield chunk.astype({col: object for col in chunk.columns if isinstance(chunk[col].dtype, pd.CategoricalDtype)})
+
+
+def chunksize_for(path, memory_limit_mb):
+    """Number of rows per chunk so that a chunk takes CHUNK_MEMORY_SHARE of the memory ceiling."""
+    sample = next(read_chunks(path, 10000))
+    bytes_per_row = sample.memory_usage(deep=True).sum() / max(sample.shape[0], 1)
+    return max(1000, int(memory_limit_mb * 1e6 * CHUNK_MEMORY_SHARE / bytes_per_row))
+
+
+class RunningMoments:
+    """Count, mean and sum of squared deviations of the known values of a column, merged chunk by chunk."""
+
+    def __init__(self):
+        self.rows = 0
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, values):
+        values = np.asarray(values, dtype=float)
+        self.rows += values.shape[0]
+        values = values[~np.isnan(values)]
+        if not values.shape[0]:
+            return
+        mean = values.mean()
+        m2 = ((values - mean) ** 2).sum()
+        # Chan et al. pairwise update, stable for large counts
+        total = self.count + values.shape[0]
+        delta = mean - self.mean
+        self.mean += delta * values.shape[0] / total
+        self.m2 += m2 + delta ** 2 * self.count * values.shape[0] / total
+        self.count = total
+
+    @property
+    def imputed_std(self):
+        """Standard deviation once the missing values are imputed by the mean, which adds no deviation."""
+        return np.sqrt(self.m2 / self.rows) if self.rows else 0.0
+
+
+class RunningR2:
+    """Coefficient of determination accumulated chunk by chunk."""
+
+    def __init__(self):
+        self.n = 0
+        self.total = 0.0
+        self.squares = 0.0
+        self.residuals = 0.0
+
+    def update(self, y_true, y_pred):
+        y_true = np.asarray(y_true, dtype=float)
+        self.n += y_true.shape[0]
+        self.total += y_true.sum()
+        self.squares += (y_true ** 2).sum()
+        self.residuals += ((y_true - np.asarray(y_pred, dtype=float)) ** 2).sum()
+
+    @property
+    def score(self):
+        return 1 - self.residuals / (self.squares - self.total ** 2 / self.n)
+
+
+class ChunkedDataset:
+    """
+    Like train.Dataset for a file read by chunks: the cleaner, mapper and preprocessor (unfitted
+    steps of the pipeline) are fitted from statistics gathered chunk by chunk. Each car is put in
+    the test set with probability `test_size`, drawn the same way at each reading of the file.
+    """
+
+    def __init__(self, path, cleaner, mapper, preprocessor, numeric_features, target, chunksize,
+                 test_size=0.2, seed=0):
+        self.path = path
+        self.cleaner = cleaner
+        self.mapper = mapper
+        self.preprocessor = preprocessor
+        self.numeric_features = numeric_features
+        self.target = target
+        self.chunksize = chunksize
+        self.test_size = test_size
+        self.seed = seed
+        self.chunks = 0
+
+    def splits(self):
+        """(X_train, Y_train, X_test, Y_test) of each chunk, cleaned."""
+        random = np.random.default_rng(self.seed)
+        for chunk in read_chunks(self.path, self.chunksize):
+            is_test = random.random(chunk.shape[0]) < self.test_size
+            kept = ~self.cleaner.rare_mask(chunk)
+            chunk = self.cleaner.transform(chunk.loc[kept, :])
+            X, Y = chunk.drop(columns=self.target), chunk[self.target]
+            yield X.loc[~is_test[kept], :], Y.loc[~is_test[kept]], X.loc[is_test[kept], :], Y.loc[is_test[kept]]
+
+    def fit_steps(self):
+        combinations = None
+        for chunk in read_chunks(self.path, self.chunksize):
+            counts = self.cleaner.combinations(chunk)
+            combinations = counts if combinations is None else combinations.add(counts, fill_value=0)
+            self.chunks += 1
+        self.cleaner.fit_combinations(combinations.astype('int64'))
+        self.mapper.fit()
+
+        moments, categories, dtypes = {}, {}, None
+        for X_train, _, _, _ in self.splits():
+            X_train = self.mapper.transform(X_train)
+            if dtypes is None:
+                dtypes = X_train.dtypes
+                moments = {col: RunningMoments() for col in self.numeric_features}
+                categories = {col: set() for col in X_train.columns if col not in self.numeric_features}
+            for col, running in moments.items():
+                running.update(X_train[col])
+            for col, known in categories.items():
+                known.update(X_train[col].dropna().unique())
+        self.preprocessor.fit(self.summary(dtypes, moments, categories))
+        return self
+
+    @staticmethod
+    def summary(dtypes, moments, categories):
+        """
+        Small frame with the same statistics as the training set: each numeric feature at its mean
+        plus or minus its standard deviation, and every category. Fitting the preprocessor on it
+        gives the imputation values, means, scales and categories of the whole training set.
+        """
+        rows = max([2] + [len(known) for known in categories.values()])
+        rows += rows % 2
+        summary = {}
+        for col, dtype in dtypes.items():
+            if col in moments:
+                summary[col] = moments[col].mean + moments[col].imputed_std * np.resize([1.0, -1.0], rows)
+            else:
+                summary[col] = pd.Series(np.resize(np.array(sorted(categories[col]), dtype=object), rows)).astype(dtype)
+        return pd.DataFrame(summary)
+
+    def transform(self, X):
+        """Encoded features of cleaned cars."""
+        return self.preprocessor.transform(self.mapper.transform(X))
+
+    def sample(self, rows=1000):
+        """First training and test cars, cleaned, to infer the signature and check the ONNX export."""
+        X_train, _, X_test, _ = next(self.splits())
+        return X_train.head(rows), X_test.head(rows)
+
+    def pipeline(self, regressor):
+        return Pipeline(steps=[
+            ("Cleaning", self.cleaner),
+            ("Mapping", self.mapper),
+            ("Preprocessing", self.preprocessor),
+            ("Regressor", regressor)
+        ])
+
+
+class TrainingChunks(xgb.DataIter):
+    """Encoded training chunks of a ChunkedDataset, read by XGBoost as many times as it needs."""
+
+    def __init__(self, dataset, cache_prefix):
+        self.dataset = dataset
+        self._splits = None
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        if self._splits is None:
+            self._splits = self.dataset.splits()
+        for X_train, Y_train, _, _ in self._splits:
+            if X_train.shape[0]:
+                input_data(data=self.dataset.transform(X_train), label=Y_train.to_numpy(dtype=float))
+                return True
+        return False
+
+    def reset(self):
+        self._splits = None
+
+
+def train_xgboost(dataset, regressor, cache_dir):
+    """
+    Fit the XGBRegressor `regressor` (its hyperparameters) on the chunks of `dataset`, with the
+    pages of the quantized matrix kept in `cache_dir` instead of memory.
+    """
+    iterator = TrainingChunks(dataset, os.path.join(cache_dir, 'xgboost'))
+    if hasattr(xgb, 'ExtMemQuantileDMatrix'):
+        matrix = xgb.ExtMemQuantileDMatrix(iterator, max_bin=regressor.max_bin or 256)
+    else:
+        matrix = xgb.DMatrix(iterator)
+    booster = xgb.train(regressor.get_xgb_params(), matrix, num_boost_round=regressor.n_estimators or 100)
+    regressor.load_model(bytearray(booster.save_raw()))
+    return regressor
+
+
+def evaluate(dataset, regressor):
+    """R2 of a fitted regressor on the training and test cars of `dataset`, chunk by chunk."""
+    train, test = RunningR2(), RunningR2()
+    for X_train, Y_train, X_test, Y_test in dataset.splits():
+        for running, X, Y in ((train, X_train, Y_train), (test, X_test, Y_test)):
+            if X.shape[0]:
+                running.update(Y, regressor.predict(dataset.transform(X)))
+    return {'R2_train': train.score, 'R2_test': test.score}
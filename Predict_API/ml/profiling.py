@@ -0,0 +1,115 @@
+import os
+import resource
+import threading
+import time
+import numpy as np
+
+
+#### Cost of the training steps and of serving the models, logged to MLflow with the candidates.
+
+def rss_mb():
+    """Resident memory of this process in MB (peak since the start of the process without /proc)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1e6
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3
+
+
+class PeakMemory:
+    """Peak resident memory of the process during the block, sampled every `interval` seconds (MB)."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, rss_mb())
+
+    def __enter__(self):
+        self.start = self.peak = rss_mb()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, rss_mb())
+
+
+def directory_size_mb(directory):
+    return sum(os.path.getsize(os.path.join(root, name))
+               for root, _, names in os.walk(directory) for name in names) / 1e6
+
+
+def latencies_ms(latencies, prefix):
+    latencies = np.array(latencies) * 1000
+    return {f'{prefix}_p50_ms': float(np.percentile(latencies, 50)),
+            f'{prefix}_p99_ms': float(np.percentile(latencies, 99))}
+
+
+def inference_cost(model_dir, pipeline, X, single_rows=200, batch_sizes=(100, 1000), repeat=5):
+    """
+    Serving cost of a model saved by MLflow in `model_dir` (`pipeline` being the fitted model),
+    measured the way the API serves it on cars of X: size of the artifact, time to load it,
+    latency of single cars (through MLflow, and compiled like with FAST_INFERENCE), latency and
+    throughput of batches.
+    """
+    import mlflow
+    from fast_path import CompiledPipeline
+
+    cost = {'model_size_mb': directory_size_mb(model_dir)}
+    start = time.perf_counter()
+    model = mlflow.pyfunc.load_model(model_dir)
+    cost['load_seconds'] = time.perf_counter() - start
+
+    cars = X.sample(max(single_rows, max(batch_sizes)), replace=True, random_state=0).reset_index(drop=True)
+    model.predict(cars.head(1))
+    latencies = []
+    for i in range(single_rows):
+        start = time.perf_counter()
+        model.predict(cars.iloc[[i]])
+        latencies.append(time.perf_counter() - start)
+    cost.update(latencies_ms(latencies, 'single'))
+
+    try:
+        compiled = CompiledPipeline(pipeline)
+    except NotImplementedError:
+        compiled = None
+    if compiled is not None:
+        latencies = []
+        for car in cars.head(single_rows).to_dict(orient='records'):
+            start = time.perf_counter()
+            compiled.predict_one(car)
+            latencies.append(time.perf_counter() - start)
+        cost.update(latencies_ms(latencies, 'compiled_single'))
+
+    for batch_size in batch_sizes:
+        batch = cars.head(batch_size)
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            model.predict(batch)
+            latencies.append(time.perf_counter() - start)
+        cost.update(latencies_ms(latencies, f'batch_{batch_size}'))
+        cost[f'batch_{batch_size}_rows_per_second'] = batch_size * repeat / sum(latencies)
+    return cost
+
+
+def budget_violations(metrics, budgets):
+    """
+    Metrics outside of their budget ({metric: value}), as messages: throughputs (per_second)
+    are minimums, the other budgets maximums. A budget on a metric that was not measured fails.
+    """
+    violations = []
+    for name, budget in budgets.items():
+        value = metrics.get(name)
+        if value is None:
+            violations.append(f'{name} not measured')
+        elif name.endswith('per_second') and value < budget:
+            violations.append(f'{name} {value:.2f} < {budget}')
+        elif not name.endswith('per_second') and value > budget:
+            violations.append(f'{name} {value:.2f} > {budget}')
+    return violations
@@ -1,11 +1,14 @@
 import os
-#import argparse
+import sys
+import json
+import argparse
+import tempfile
 import pandas as pd
-import numpy as np
 import time
 import mlflow
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from mlflow.models.signature import infer_signature
-from sklearn.model_selection import train_test_split 
+from sklearn.model_selection import train_test_split, ParameterGrid
 from sklearn.impute import SimpleImputer
 from sklearn.preprocessing import  StandardScaler, OneHotEncoder
 from sklearn.compose import ColumnTransformer
@@ -15,141 +18,351 @@ from sklearn.ensemble import RandomForestRegressor, AdaBoostRegressor
 from sklearn.metrics import r2_score
 from xgboost import XGBRegressor
 
-mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
+# The grouping of categories is shared with the API, and logged with the model
+FEATURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'API', 'src', 'features.py')
+sys.path.insert(0, os.path.dirname(FEATURES_PATH))
+from features import DataCleaner, FeatureMapper, DEFAULT_MAPPING, VALID_RANGES, RARE_COLUMNS
+# Datasets are downloaded once and kept locally, see Streamlit_Dashboard/datastore.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'Streamlit_Dashboard'))
+from datastore import load, DataStore
+from export_onnx import log_onnx_model
+from profiling import PeakMemory, inference_cost, budget_violations
+from out_of_core import ChunkedDataset, read_chunks, chunksize_for, train_xgboost, evaluate
 
+mlflow.set_tracking_uri(os.environ["MLFLOW_TRACKING_URI"])
 
-if __name__ == "__main__":
 
-    ### MLFLOW Experiment setup
-    experiment_name="Getaround_PredictPricing"
-    mlflow.set_experiment(experiment_name)
-    experiment = mlflow.get_experiment_by_name(experiment_name)
-    MODEL_NAME = "XGBRegressor" # RandomForestRegressor, LinearRegression, XGBRegressor, AdaBoostRegressor
-    DF_PREPROCESS = "wo10Cats" # wo10Cats, AllCats
+#### Search over the models and the preprocessing of the dataset, the candidates being trained in
+#### parallel by a pool of processes. Each candidate is logged as a nested run of one run per search.
+####   python train.py                                        # every model and preprocessing
+####   python train.py --models XGBRegressor --preprocess AllCats --workers 4
+####   python train.py --search-space space.json              # {"XGBRegressor": {"max_depth": [4, 6]}}
+#### With --out-of-core, the XGBRegressor (first values of its SEARCH_SPACE) is trained on a file read
+#### by chunks instead, for datasets too large to be loaded at once (see out_of_core.py):
+####   python train.py --out-of-core --data pricing_history.parquet --memory-limit-mb 4096
 
-    client = mlflow.tracking.MlflowClient()
-    #run = client.create_run(experiment.experiment_id)
+MODELS = {
+    'RandomForestRegressor': RandomForestRegressor,
+    'XGBRegressor': XGBRegressor,
+    'LinearRegression': LinearRegression,
+    'AdaBoostRegressor': AdaBoostRegressor,
+}
+# Every combination of the hyperparameters is a candidate, the first values are the ones used so far
+SEARCH_SPACE = {
+    'RandomForestRegressor': {'max_depth': [15, 10], 'min_samples_leaf': [2], 'min_samples_split': [4],
+                              'n_estimators': [200]},
+    'XGBRegressor': {'max_depth': [4, 6], 'min_child_weight': [10, 1], 'n_estimators': [125, 250]},
+    'LinearRegression': {},
+    'AdaBoostRegressor': {'learning_rate': [1.0], 'loss': ['exponential', 'linear'], 'n_estimators': [10, 50]},
+}
+DF_PREPROCESS = ["wo10Cats", "AllCats"]
+NUMERIC_FEATURES = ["mileage", "engine_power"]
+TARGET = "rental_price_per_day"
 
-    # Parse arguments given in shell script
-    # parser = argparse.ArgumentParser()
-    # parser.add_argument("--n_estimators")
-    # parser.add_argument("--min_samples_split")
-    # args = parser.parse_args()
-
-    # Import and preprocess dataset
-    pricing = pd.read_csv('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv')
-    pricing.drop("Unnamed: 0", axis=1, inplace=True)
 
-    indexes_mileage = []
-    indexes_mileage.append(pricing.loc[(pricing['mileage'] < 0), 'mileage'].index.to_list())
-    indexes_mileage.append(pricing.loc[(pricing['mileage'] > 1000000), 'mileage'].index.to_list())
-    indexes_power = []
-    indexes_power.append(pricing.loc[(pricing['engine_power'] == 0),'engine_power'].index.to_list())
-    indexes_power.append(pricing.loc[(pricing['engine_power'] > 400),'engine_power'].index.to_list())
-
-    for index in indexes_mileage:
-        for ind in index:
-            pricing.at[ind, 'mileage'] = np.nan
-    for index in indexes_power:
-        for ind in index:
-            pricing.at[ind, 'engine_power'] = np.nan
-
-    if DF_PREPROCESS == 'wo10Cats':
-        for col in ["fuel", 'model_key', 'paint_color']:
-            df_counts = pd.DataFrame(pricing[col].value_counts())
-            for category in df_counts.loc[df_counts['count']<=10,:].index.to_list():
-                for row in pricing.loc[pricing[col]==category].index.to_list():
-                    pricing.drop(row, axis=0, inplace=True)
+def make_steps(df_preprocess):
+    """
+    Unfitted "Cleaning" and "Mapping" steps of a preprocessing: outliers replaced by NaN and, for
+    wo10Cats, cars of the categories seen 10 times or less dropped, or else grouped.
+    """
+    cleaner = DataCleaner(VALID_RANGES, RARE_COLUMNS, rare_threshold=10 if df_preprocess == 'wo10Cats' else None)
+    if df_preprocess == 'wo10Cats':
+        mapping = {}
     else:
-        dict_changes = {}
-        dict_changes['model_key'] = {'Fiat': 'low_price', 'Mazda': 'low_price', 'Ford': 'low_price', 'Mercedes': 'low_price',
-                                    'Porsche': 'medium_price', 'Honda': 'medium_price', 'Yamaha': 'medium_price', 
-                                    'Lamborghini': 'medium_price', 'Alfa Romeo': 'medium_price', 'KIA Motors': 'medium_price', 
-                                    'Opel': 'medium_price',
-                                    'Suzuki': 'high_price', 'Mini': 'high_price', 'Lexus': 'high_price', 'Maserati': 'high_price'
-                                    }
-        dict_changes['fuel'] = {'hybrid_petrol': 'high_price', 'electro': 'high_price'}
-        dict_changes['paint_color'] = {'orange': 'high_price', 'white': 'high_price'}
-        for col in dict_changes.keys():
-            pricing = pricing.replace({col: dict_changes[col]})
-
-    # X, y split 
-    features_list = list(pricing.columns)
-    features_list.remove('rental_price_per_day')
-    target_variable = 'rental_price_per_day'
-    X = pricing.loc[:, features_list]
-    Y = pricing.loc[:, target_variable]
-    X_train, X_test, Y_train, Y_test = train_test_split(X, Y, test_size=0.2, random_state=0)
-
-    # Preprocessing 
-    categorical_features = features_list
-    categorical_features.remove("mileage")
-    categorical_features.remove("engine_power")
-    numeric_features = ["mileage", "engine_power"]
+        # Rare categories are grouped by the "Mapping" step of the pipeline
+        mapping = DEFAULT_MAPPING
+    return cleaner, FeatureMapper(mapping)
+
 
+def make_preprocessor(features_list):
+    """Unfitted "Preprocessing" step."""
+    categorical_features = [col for col in features_list if col not in NUMERIC_FEATURES]
     numeric_transformer = Pipeline(
         steps=[
-            ("imputer", SimpleImputer(strategy="mean")),  
+            ("imputer", SimpleImputer(strategy="mean")),
             ("scaler", StandardScaler()),
         ]
     )
     categorical_transformer = OneHotEncoder(drop="first")
-    preprocessor = ColumnTransformer(
+    return ColumnTransformer(
         transformers=[
-            ("num", numeric_transformer, numeric_features),
+            ("num", numeric_transformer, NUMERIC_FEATURES),
             ("cat", categorical_transformer, categorical_features),
         ]
     )
 
-    print("training model...")
-    
-    # Time execution
-    start_time = time.time()
 
-    # Define model 
-    if MODEL_NAME == 'RandomForestRegressor':
-        model = Pipeline(steps=[
-        ("Preprocessing", preprocessor),
-        ("Regressor", RandomForestRegressor(max_depth=15, min_samples_leaf=2, 
-                    min_samples_split=4, n_estimators=200))
-        ], verbose=True)
-    elif MODEL_NAME == 'XGBRegressor':
-        model = Pipeline(steps=[
-        ("Preprocessing", preprocessor),
-        ("Regressor", XGBRegressor(max_depth=4, min_child_weight=10, n_estimators=125))
-        ], verbose=True)
-    elif MODEL_NAME == 'LinearRegression':
-        model = Pipeline(steps=[
-        ("Preprocessing", preprocessor),
-        ("Regressor", LinearRegression())
-        ], verbose=True)
-    else: # AdaBoostRegressor
-        model = Pipeline(steps=[
-        ("Preprocessing", preprocessor),
-        ("Regressor", AdaBoostRegressor(learning_rate=1.0, loss='exponential', n_estimators=10))
-        ], verbose=True)
-
-    # Log experiment to MLFlow
-    with mlflow.start_run(experiment_id = experiment.experiment_id) as run:
-        mlflow.sklearn.autolog() 
-        mlflow.log_param("type_MLmodel", MODEL_NAME) 
-        mlflow.log_param("type_preprocess", DF_PREPROCESS) 
-
-        model.fit(X_train, Y_train)
-        Y_train_pred = model.predict(X_train)
-        Y_test_pred = model.predict(X_test)
-
-        mlflow.log_metric('R2_train', r2_score(Y_train, Y_train_pred))
-        mlflow.log_metric('R2_test', r2_score(Y_test, Y_test_pred))
-
-        # Log model separately to have more flexibility on setup 
+class Dataset:
+    """
+    Train / test split of one preprocessing of the dataset, with the "Cleaning", "Mapping" and
+    "Preprocessing" steps of the pipeline fitted once and the transformed features shared by all the candidates.
+    """
+
+    def __init__(self, pricing, df_preprocess, test_size=0.2):
+        self.df_preprocess = df_preprocess
+        self.cleaner, self.mapper = make_steps(df_preprocess)
+        self.cleaner.fit(pricing)
+        pricing = self.cleaner.transform(self.cleaner.drop_rare(pricing))
+
+        # X, y split
+        features_list = list(pricing.columns)
+        features_list.remove(TARGET)
+        X = pricing.loc[:, features_list]
+        Y = pricing.loc[:, TARGET]
+        self.X_train, self.X_test, self.Y_train, self.Y_test = train_test_split(X, Y, test_size=test_size, random_state=0)
+
+        # Preprocessing
+        self.preprocessor = make_preprocessor(features_list)
+        self.features_train = self.preprocessor.fit_transform(self.mapper.fit_transform(self.X_train))
+        self.features_test = self.preprocessor.transform(self.mapper.transform(self.X_test))
+
+    def pipeline(self, regressor):
+        """Pipeline served by the API: the fitted steps of the dataset and a fitted regressor."""
+        return Pipeline(steps=[
+            ("Cleaning", self.cleaner),
+            ("Mapping", self.mapper),
+            ("Preprocessing", self.preprocessor),
+            ("Regressor", regressor)
+        ])
+
+
+def candidates(models, search_space, workers):
+    """(model name, hyperparameters) of every candidate of the search."""
+    for model_name in models:
+        for params in ParameterGrid(search_space.get(model_name, {})):
+            # One core per candidate when they are trained in parallel
+            if workers > 1 and 'n_jobs' in MODELS[model_name]().get_params():
+                params = dict(params, n_jobs=1)
+            yield model_name, params
+
+
+# Transformed features of each Dataset, sent once to each process of the pool
+_features = {}
+
+def init_worker(features):
+    _features.update(features)
+
+
+def fit_candidate(df_preprocess, model_name, params):
+    """Fitted regressor of a candidate, with its scores and costs."""
+    features_train, features_test, Y_train, Y_test = _features[df_preprocess]
+    regressor = MODELS[model_name](**params)
+    with PeakMemory() as memory:
+        start_time = time.perf_counter()
+        regressor.fit(features_train, Y_train)
+        fit_seconds = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        Y_test_pred = regressor.predict(features_test)
+        predict_seconds = time.perf_counter() - start_time
+    return regressor, {
+        'R2_train': r2_score(Y_train, regressor.predict(features_train)),
+        'R2_test': r2_score(Y_test, Y_test_pred),
+        'fit_seconds': fit_seconds,
+        'predict_test_seconds': predict_seconds,
+        'peak_memory_mb': memory.peak,
+        'fit_memory_increase_mb': memory.peak - memory.start,
+    }
+
+
+def log_candidate(model, model_name, df_preprocess, params, metrics, X_train, X_test, onnx=True,
+                  bench_rows=200, budgets=None):
+    """
+    Nested run of a candidate, with its model and its serving cost (see profiling.inference_cost).
+    Returns the run id and the metrics, the tag within_budget tells if they are within `budgets`.
+    """
+    signature = infer_signature(X_train, model.predict(X_train))
+    with tempfile.TemporaryDirectory() as directory:
+        # Measured on the model saved like the one logged, as the API loads it
+        mlflow.sklearn.save_model(model, os.path.join(directory, "model"), signature=signature,
+                                  code_paths=[FEATURES_PATH])
+        metrics = dict(metrics, **inference_cost(os.path.join(directory, "model"), model, X_test,
+                                                 single_rows=bench_rows))
+    violations = budget_violations(metrics, budgets or {})
+
+    with mlflow.start_run(run_name=f"{model_name}_{df_preprocess}", nested=True) as run:
+        mlflow.log_param("type_MLmodel", model_name)
+        mlflow.log_param("type_preprocess", df_preprocess)
+        mlflow.log_params(params)
+        mlflow.log_metrics(metrics)
+        mlflow.set_tag("within_budget", str(not violations).lower())
+        if violations:
+            mlflow.set_tag("budget_violations", "; ".join(violations))
+
+        # Log model separately to have more flexibility on setup
         mlflow.sklearn.log_model(
             sk_model=model,
             artifact_path="Getaround_PredictPricing",
-            #registered_model_name="Getaround_PredictPricing_"+str(MODEL_NAME)+"_"+str(DF_PREPROCESS),
-            signature=infer_signature(X_train, Y_train_pred)
+            signature=signature,
+            code_paths=[FEATURES_PATH]
         )
-        #mlflow.end_run()
-        
+
+        # Lighter ONNX version of the model, served by the API with SERVING_MODE=onnx
+        if onnx:
+            try:
+                log_onnx_model(model, X_train, X_test, run.info.run_id)
+            except Exception as e:
+                print(f"ONNX export failed: {e}")
+    return run.info.run_id, metrics, violations
+
+
+def register(results, name):
+    """
+    Register the model of the candidate with the best R2_test among those within their budgets
+    (dicts with run_id, R2_test and violations) as a new version of `name`.
+    """
+    eligible = [result for result in results if not result['violations']]
+    if not eligible:
+        print(f"no candidate within the budgets, {name} not registered")
+        return None
+    best = max(eligible, key=lambda result: result['R2_test'])
+    version = mlflow.register_model(f"runs:/{best['run_id']}/Getaround_PredictPricing", name)
+    print(f"run {best['run_id']} registered as {name} version {version.version}")
+    return version
+
+
+def run_search(args, search_space):
+    # Import and preprocess dataset
+    pricing = load('pricing', categorical=False)
+    pricing.drop("Unnamed: 0", axis=1, inplace=True)
+    datasets = {df_preprocess: Dataset(pricing, df_preprocess, args.test_size) for df_preprocess in args.preprocess}
+    features = {name: (dataset.features_train, dataset.features_test, dataset.Y_train, dataset.Y_test)
+                for name, dataset in datasets.items()}
+    tasks = [(df_preprocess, model_name, params) for df_preprocess in args.preprocess
+             for model_name, params in candidates(args.models, search_space, args.workers)]
+
+    print(f"training {len(tasks)} models with {args.workers} processes...")
+
+    results = []
+    with mlflow.start_run(run_name="search") as run:
+        mlflow.log_params({"models": ",".join(args.models), "type_preprocess": ",".join(args.preprocess),
+                           "candidates": len(tasks), "workers": args.workers})
+        mlflow.log_params({f"budget_{name}": value for name, value in args.budgets.items()})
+        trained = []
+        with ProcessPoolExecutor(args.workers, initializer=init_worker, initargs=(features,)) as executor:
+            futures = {executor.submit(fit_candidate, *task): task for task in tasks}
+            for future in as_completed(futures):
+                df_preprocess, model_name, params = futures[future]
+                try:
+                    trained.append((df_preprocess, model_name, params) + future.result())
+                except Exception as e:
+                    print(f"{model_name} {df_preprocess} {params} failed: {e}")
+
+        # Logged once the pool is done, so that the inference costs are not measured on busy cores
+        for df_preprocess, model_name, params, regressor, metrics in trained:
+            dataset = datasets[df_preprocess]
+            run_id, metrics, violations = log_candidate(
+                dataset.pipeline(regressor), model_name, df_preprocess, params, metrics, dataset.X_train,
+                dataset.X_test, onnx=not args.no_onnx, bench_rows=args.bench_rows, budgets=args.budgets)
+            print(f"{model_name} {df_preprocess} {params}: R2_test {metrics['R2_test']:.4f}, "
+                  f"fit {metrics['fit_seconds']:.1f}s, peak memory {metrics['peak_memory_mb']:.0f}MB, "
+                  f"p99 {metrics['single_p99_ms']:.1f}ms" + (f", over budget: {'; '.join(violations)}" if violations else ""))
+            results.append(dict(run_id=run_id, type_MLmodel=model_name, type_preprocess=df_preprocess,
+                                params=params, violations=violations, **metrics))
+
+        if args.register:
+            register(results, args.register)
+        if results:
+            comparison = pd.DataFrame(results).sort_values('R2_test', ascending=False)
+            mlflow.log_text(comparison.to_csv(index=False), "candidates.csv")
+            best = comparison.iloc[0]
+            mlflow.set_tag("best_run_id", best['run_id'])
+            mlflow.log_metric("best_R2_test", best['R2_test'])
+            print(comparison.loc[:, ['run_id', 'type_MLmodel', 'type_preprocess', 'R2_test', 'fit_seconds',
+                                     'peak_memory_mb', 'single_p99_ms', 'batch_1000_rows_per_second',
+                                     'model_size_mb']].to_string(index=False))
+
+
+def run_out_of_core(args, search_space):
+    data = args.data or DataStore().path('pricing')
+    chunksize = args.chunksize or chunksize_for(data, args.memory_limit_mb)
+    params = {name: values[0] for name, values in search_space.get('XGBRegressor', {}).items()}
+    features_list = [col for col in next(read_chunks(data, 1000)).columns if col != TARGET]
+
+    print(f"training XGBRegressor out of core on {data}, {chunksize} rows per chunk...")
+
+    with mlflow.start_run(run_name="out_of_core"), \
+            tempfile.TemporaryDirectory(prefix='getaround_xgboost_', dir=args.cache_dir) as cache_dir:
+        results = []
+        mlflow.log_params({"data": data, "chunksize": chunksize, "memory_limit_mb": args.memory_limit_mb,
+                           "type_preprocess": ",".join(args.preprocess)})
+        mlflow.log_params({f"budget_{name}": value for name, value in args.budgets.items()})
+        for df_preprocess in args.preprocess:
+            cleaner, mapper = make_steps(df_preprocess)
+            dataset = ChunkedDataset(data, cleaner, mapper, make_preprocessor(features_list), NUMERIC_FEATURES,
+                                     TARGET, chunksize, args.test_size)
+            # Peak resident memory of each stage, against the ceiling
+            stages = {}
+            start_time = time.perf_counter()
+            with PeakMemory() as stages['statistics']:
+                dataset.fit_steps()
+            statistics_seconds = time.perf_counter() - start_time
+            start_time = time.perf_counter()
+            with PeakMemory() as stages['fit']:
+                regressor = train_xgboost(dataset, XGBRegressor(**params), cache_dir)
+            fit_seconds = time.perf_counter() - start_time
+            with PeakMemory() as stages['evaluation']:
+                metrics = evaluate(dataset, regressor)
+
+            peak_memory = max(memory.peak for memory in stages.values())
+            metrics.update({f'{stage}_peak_memory_mb': memory.peak for stage, memory in stages.items()})
+            metrics.update(statistics_seconds=statistics_seconds, fit_seconds=fit_seconds, chunks=dataset.chunks,
+                           peak_memory_mb=peak_memory, memory_limit_exceeded=float(peak_memory > args.memory_limit_mb))
+            if peak_memory > args.memory_limit_mb:
+                print(f"peak memory {peak_memory:.0f}MB above the ceiling of {args.memory_limit_mb}MB: "
+                      f"lower --chunksize")
+            X_train, X_test = dataset.sample()
+            run_id, metrics, violations = log_candidate(
+                dataset.pipeline(regressor), 'XGBRegressor', df_preprocess,
+                dict(params, chunksize=chunksize, memory_limit_mb=args.memory_limit_mb), metrics, X_train, X_test,
+                onnx=not args.no_onnx, bench_rows=args.bench_rows, budgets=args.budgets)
+            print(f"XGBRegressor {df_preprocess}: R2_test {metrics['R2_test']:.4f}, fit {fit_seconds:.1f}s, "
+                  f"peak memory {peak_memory:.0f}MB, p99 {metrics['single_p99_ms']:.1f}ms")
+            results.append(dict(run_id=run_id, R2_test=metrics['R2_test'], violations=violations))
+
+        if args.register:
+            register(results, args.register)
+
+
+if __name__ == "__main__":
+
+    # Parse arguments given in shell script
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", nargs="+", choices=list(MODELS), default=list(MODELS))
+    parser.add_argument("--preprocess", nargs="+", choices=DF_PREPROCESS, default=DF_PREPROCESS)
+    parser.add_argument("--search-space", help="JSON file of the hyperparameters to try per model, "
+                                               "replacing those of SEARCH_SPACE")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="processes training the candidates")
+    parser.add_argument("--test-size", type=float, default=0.2)
+    parser.add_argument("--no-onnx", action="store_true", help="do not export the candidates to ONNX")
+    parser.add_argument("--experiment", default="Getaround_PredictPricing")
+    parser.add_argument("--out-of-core", action="store_true", help="train the XGBRegressor on --data read by chunks")
+    parser.add_argument("--data", help="Parquet, Arrow or CSV file of --out-of-core, the pricing dataset by default")
+    parser.add_argument("--chunksize", type=int, help="rows per chunk, by default sized from --memory-limit-mb")
+    parser.add_argument("--memory-limit-mb", type=float, default=2048, help="memory ceiling of --out-of-core")
+    parser.add_argument("--cache-dir", help="where XGBoost keeps its external memory pages, "
+                                                          "the temporary directory by default")
+    parser.add_argument("--bench-rows", type=int, default=200, help="single cars predicted to measure the latency")
+    parser.add_argument("--budget", nargs="*", default=[], metavar="METRIC=VALUE",
+                        help="serving budgets, e.g. single_p99_ms=20 model_size_mb=50 "
+                             "batch_1000_rows_per_second=10000 (minimum for throughputs)")
+    parser.add_argument("--register", metavar="NAME", help="register the best model within the budgets under NAME")
+    args = parser.parse_args()
+    args.budgets = {name: float(value) for name, value in (budget.split("=", 1) for budget in args.budget)}
+
+    search_space = dict(SEARCH_SPACE)
+    if args.search_space:
+        with open(args.search_space) as f:
+            search_space.update(json.load(f))
+
+    ### MLFLOW Experiment setup
+    mlflow.set_experiment(args.experiment)
+
+    # Time execution
+    start_time = time.time()
+    if args.out_of_core:
+        run_out_of_core(args, search_space)
+    else:
+        run_search(args, search_space)
+
     print("...Done!")
-    print(f"---Total training time: {time.time()-start_time}")
\ No newline at end of file
+    print(f"---Total training time: {time.time()-start_time}")
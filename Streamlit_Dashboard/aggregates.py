@@ -0,0 +1,91 @@
+import numpy as np
+import pandas as pd
+
+from thresholds import SortedDeltas
+
+
+#### Compact summaries of the datasets for the charts of the dashboard: the figures receive a few
+#### hundred rows (counts per group, bins of a histogram, points of an ECDF) instead of the rental
+#### chains or the pricing dataset, so that the page sent to the browser does not grow with the data.
+
+ECDF_POINTS = 200
+HISTOGRAM_BINS = 50
+
+
+def grouped_counts(frame, by):
+    """Number of rows of each combination of the columns `by`, in a 'count' column."""
+    counts = frame.groupby(list(by), observed=True).size().rename('count').reset_index()
+    return counts.loc[counts['count'] > 0, :].reset_index(drop=True)
+
+
+def ecdf_table(frame, value, by=None, points=ECDF_POINTS):
+    """
+    Empirical cumulative distribution of the column `value`, per group of the column `by`: at most
+    `points` (value, probability) steps per group, the probability being the exact share of the
+    rows of the group at or below the value. Groups with fewer rows keep all their values.
+    """
+    groups = frame.groupby(by, observed=True)[value] if by is not None else [(None, frame[value])]
+    tables = []
+    for group, values in groups:
+        values = np.sort(values.to_numpy(dtype=float))
+        values = values[~np.isnan(values)]
+        n = values.shape[0]
+        if not n:
+            continue
+        # Last row of each step: the rows with the same value are counted together
+        last = np.flatnonzero(np.append(values[1:] != values[:-1], True))
+        if last.shape[0] > points:
+            last = last[np.unique(np.searchsorted(last, np.linspace(0, n - 1, points)))]
+        table = pd.DataFrame({value: values[last], 'probability': (last + 1) / n})
+        if by is not None:
+            table.insert(0, by, group)
+        tables.append(table)
+    if not tables:
+        return pd.DataFrame(columns=([by] if by is not None else []) + [value, 'probability'])
+    return pd.concat(tables, ignore_index=True)
+
+
+def binned_histogram(frame, value, by=None, bins=HISTOGRAM_BINS):
+    """Counts of the column `value` in `bins` bins of the same width, per group of the column `by`."""
+    values = frame[value].to_numpy(dtype=float)
+    edges = np.histogram_bin_edges(values[~np.isnan(values)], bins)
+    groups = frame.groupby(by, observed=True)[value] if by is not None else [(None, frame[value])]
+    tables = []
+    for group, group_values in groups:
+        counts, _ = np.histogram(group_values.to_numpy(dtype=float), edges)
+        table = pd.DataFrame({value: (edges[:-1] + edges[1:]) / 2, 'bin_start': edges[:-1],
+                              'bin_end': edges[1:], 'count': counts})
+        if by is not None:
+            table.insert(0, by, group)
+        tables.append(table)
+    return pd.concat(tables, ignore_index=True)
+
+
+class ThresholdCounts:
+    """
+    Rentals of each combination of the columns `by` below and above any threshold of their time
+    delta with the previous rental: the deltas of each group are sorted once, like in thresholds.py.
+    """
+
+    def __init__(self, rentals, by):
+        self.by = list(by)
+        self.groups = {key if isinstance(key, tuple) else (key,): SortedDeltas(group)
+                       for key, group in rentals.groupby(self.by, observed=True) if group.shape[0]}
+
+    def counts(self, threshold, where=None):
+        """grouped_counts with a 'threshold' column, for the groups whose columns match `where` ({column: value})."""
+        rows = []
+        for key, deltas in self.groups.items():
+            labels = dict(zip(self.by, key))
+            if where and any(labels[col] != expected for col, expected in where.items()):
+                continue
+            below = int(deltas.below(threshold))
+            for label, count in (('below_threshold', below), ('above_threshold', deltas.size - below)):
+                if count:
+                    rows.append({**labels, 'threshold': label, 'count': count})
+        return pd.DataFrame(rows, columns=self.by + ['threshold', 'count'])
+
+
+def page(frame, number, size):
+    """Rows of the page `number` (from 1) of `size` rows."""
+    return frame.iloc[(number - 1) * size:number * size]
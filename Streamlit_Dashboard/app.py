@@ -2,9 +2,19 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px 
 import plotly.graph_objects as go
-import numpy as np
+import os
 from datetime import datetime
 
+from datastore import load
+from rentals import rental_chains, delayed_chains
+from thresholds import threshold_sweeps
+from ingestion import RentalStore
+from aggregates import grouped_counts, ecdf_table, binned_histogram, ThresholdCounts, page
+
+# Rental log ingested incrementally by ingestion.py, instead of the delay analysis file
+RENTAL_STORE = os.environ.get('GETAROUND_RENTAL_STORE')
+PAGE_SIZES = [20, 50, 100, 500]
+
 ### Config
 st.set_page_config(
     page_title="Getaround Analysis",
@@ -12,9 +22,6 @@ st.set_page_config(
     layout="wide"
 )
 
-DATA_URL_DELAY = ('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_delay_analysis.xlsx')
-DATA_URL_PRICING = ('https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv')
-
 ### App
 st.title("Streamlit dashboard to analyse a minimum delay to be implemented between two Getaround rentals")
 
@@ -30,42 +37,83 @@ st.markdown("---")
 
 
 @st.cache_data
-def load_data():
+def load_data(with_delay=True):
     try:
-        delay = pd.read_excel(DATA_URL_DELAY)
-        pricing = pd.read_csv(DATA_URL_PRICING)
+        # Downloaded once, then read from a local Arrow copy (see datastore.py)
+        delay = load('delay') if with_delay else None
+        pricing = load('pricing')
         return delay, pricing
     except Exception as e:
         st.error(f"{e}")
         return None
 
+@st.cache_data
+def prepare_rentals(delay):
+    """Rental chains, computed once per version of the delay data (see rentals.py)."""
+    delay_prevRent = rental_chains(delay)
+    return delay_prevRent, delayed_chains(delay_prevRent)
+
+@st.cache_data
+def sweep_thresholds(delay, chains, pricing):
+    """Metrics of every threshold and type of checkin, computed once per version of the data (see thresholds.py)."""
+    return threshold_sweeps(delay, chains, pricing)
+
+@st.cache_data
+def load_store(directory, version, pricing):
+    """Rental chains and sweeps of the rental store, read once per ingested chunk (see ingestion.py)."""
+    store = RentalStore(directory)
+    delay_prevRent = store.chains()
+    return delay_prevRent, delayed_chains(delay_prevRent), store.sweeps(pricing)
+
+@st.cache_data
+def summarize(chains, pricing):
+    """
+    Compact tables behind the charts, computed once per version of the data (see aggregates.py):
+    the figures get counts, bins and ECDF points instead of the rental chains and the pricing dataset.
+    """
+    late = chains.loc[chains['type_of_delay'] == 'late', :]
+    return {
+        'types_of_delay': grouped_counts(chains, ['type_of_delay']),
+        'states': grouped_counts(chains, ['state', 'checkin_type', 'type_of_delay']),
+        'ecdf': {checkin_type: ecdf_table(chains if checkin_type == 'both' else 
+                                          chains.loc[chains['checkin_type'] == checkin_type, :],
+                                          'timedelta_minus_delay', by='state')
+                 for checkin_type in ('both', 'mobile', 'connect')},
+        'late': ThresholdCounts(late, ['state', 'checkin_type']),
+        'prices': binned_histogram(pricing.astype({'has_getaround_connect': str}), 'rental_price_per_day', 
+                                   by='has_getaround_connect'),
+        'mean_prices': pricing.groupby('has_getaround_connect')['rental_price_per_day'].mean(),
+    }
+
 st.subheader("Load and showcase data")
 
 data_load_state = st.text('Loading data...')
-delay, pricing = load_data()
+delay, pricing = load_data(with_delay=not RENTAL_STORE)
 
 # Creating the temporary dataframes for the figures
-delay_prevRent = delay[pd.notna(delay["previous_ended_rental_id"])].copy().reset_index(drop=True)
-delay_prevRent['previous_ended_rental_id'] = [int(x) for x in delay_prevRent['previous_ended_rental_id']]
-delay_prevRent['previous_delay_at_checkout'] = [
-    delay[delay['rental_id'] == prev_car].delay_at_checkout_in_minutes.values[0]
-    for prev_car in delay_prevRent['previous_ended_rental_id']]
-
-delay_prevRent_woNaN = delay_prevRent[pd.notna(delay_prevRent["previous_delay_at_checkout"])].copy().reset_index(drop=True)
-delay_prevRent_woNaN['timedelta_minus_delay'] = delay_prevRent_woNaN['time_delta_with_previous_rental_in_minutes'] \
-                                                - delay_prevRent_woNaN['previous_delay_at_checkout']
-
-delay_prevRent_woNaN_previousdelay = delay_prevRent[pd.notna(delay_prevRent["previous_delay_at_checkout"])].copy().reset_index(drop=True)
-delay_prevRent_woNaN_previousdelay['type_of_delay'] = delay_prevRent_woNaN_previousdelay['previous_delay_at_checkout'].apply(lambda x: 'in_advance' if x<=0 else 
-    'late'
-)
+if RENTAL_STORE:
+    # The figures read the rental chains (every rental following another) and the aggregates of the
+    # store, not the rentals themselves: those are only read one page at a time, for the raw data
+    store = RentalStore(RENTAL_STORE)
+    delay_prevRent, delay_prevRent_woNaN, sweeps = load_store(RENTAL_STORE, store.version, pricing)
+else:
+    delay_prevRent, delay_prevRent_woNaN = prepare_rentals(delay)
+    sweeps = sweep_thresholds(delay, delay_prevRent_woNaN, pricing)
+summary = summarize(delay_prevRent_woNaN, pricing)
 
 data_load_state.text("") 
 
 ## Run the below code if the check is checked ✅
 if st.checkbox('Show raw data'):
+    # One page at a time: the browser never receives the whole table
     st.markdown('Raw data: delay')
-    st.write(delay)    
+    total_rows = delay.shape[0] if delay is not None else store.size
+    col1, col2 = st.columns(2)
+    page_size = col1.selectbox("Rows per page", PAGE_SIZES)
+    pages = max(1, -(-total_rows // page_size))
+    page_number = col2.number_input(f"Page (out of {pages})", min_value=1, max_value=pages, value=1)
+    st.dataframe(page(delay, page_number, page_size) if delay is not None else store.rentals_page(page_number, page_size))
+    st.caption(f"Rows {(page_number - 1) * page_size + 1} to {min(page_number * page_size, total_rows)} of {total_rows}")
 
 st.markdown("---")
 
@@ -84,15 +132,16 @@ st.markdown("""
 st.markdown("Question 1: How often are drivers late for the next check-in? How does it impact the next driver?")
 col1, col2 = st.columns(2)
 with col1:
-    df_pie = pd.DataFrame(delay_prevRent_woNaN_previousdelay['type_of_delay'].value_counts())
-    fig = px.pie(df_pie, values=df_pie['count'], names=df_pie.index, color=df_pie.index, 
+    df_pie = summary['types_of_delay']
+    fig = px.pie(df_pie, values='count', names='type_of_delay', color='type_of_delay', 
              color_discrete_map={'late': 'red', 'in_advance': 'green'}, 
              title="Percentage of drivers late versus in advance")
     st.plotly_chart(fig, use_container_width=True)
 with col2:
-    fig = px.histogram(delay_prevRent_woNaN_previousdelay, 'state', pattern_shape='checkin_type', 
+    fig = px.histogram(summary['states'], 'state', y='count', pattern_shape='checkin_type', 
              color='type_of_delay', text_auto=True,
              title='Impact of all types of arrival and checkin on the next driver')
+    fig.update_layout(yaxis_title='count')
     st.plotly_chart(fig, use_container_width=True)
 
 ## Choice of threshold and type of checkin
@@ -102,26 +151,35 @@ col1, col2, col3 = st.columns(3)
 
 with col1:
     st.markdown("type of checkin: both")
-    fig = px.ecdf(delay_prevRent_woNaN, color='state', x='timedelta_minus_delay', 
-              title="ECDF for both checkin types")
+    fig = px.line(summary['ecdf']['both'], color='state', x='timedelta_minus_delay', y='probability', 
+              line_shape='hv', title="ECDF for both checkin types")
     st.plotly_chart(fig, use_container_width=True)
 
 with col2:
     st.markdown("type of checkin: mobile")
-    fig = px.ecdf(delay_prevRent_woNaN.loc[delay_prevRent_woNaN['checkin_type']=='mobile',:], 
-              color='state', x='timedelta_minus_delay', title='ECDF for checkin_type mobile')
+    fig = px.line(summary['ecdf']['mobile'], color='state', x='timedelta_minus_delay', y='probability', 
+              line_shape='hv', title='ECDF for checkin_type mobile')
     st.plotly_chart(fig, use_container_width=True)
 
 with col3:
     st.markdown("type of checkin: connect")
-    fig = px.ecdf(delay_prevRent_woNaN.loc[delay_prevRent_woNaN['checkin_type']=='connect',:], 
-              color='state', x='timedelta_minus_delay', title='ECDF for checkin_type connect')
+    fig = px.line(summary['ecdf']['connect'], color='state', x='timedelta_minus_delay', y='probability', 
+              line_shape='hv', title='ECDF for checkin_type connect')
     st.plotly_chart(fig, use_container_width=True)
 
 threshold = st.selectbox("Select the threshold (in minutes) you want to try out", range(0,720))
 checkin_type = st.selectbox("Select the type of checkin you want to apply this threshold to", ['connect', 'mobile', 'both'])
-delay_prevRent_woNaN_previousdelay['threshold'] = delay_prevRent_woNaN_previousdelay['time_delta_with_previous_rental_in_minutes']\
-                .apply(lambda x: 'below_threshold' if x<=threshold else 'above_threshold')
+sweep = sweeps[checkin_type]
+effects = sweep.loc[threshold]
+
+fig = go.Figure()
+fig.add_trace(go.Scatter(x=sweep.index, y=sweep['share_rentals_lost'], name='% of all rentals potentially lost'))
+fig.add_trace(go.Scatter(x=sweep.index, y=sweep['share_problems_solved'], name='% of problematic cases solved'))
+fig.add_trace(go.Scatter(x=sweep.index, y=sweep['percent_loss'], name='% of revenue lost'))
+fig.add_vline(x=threshold, line_dash='dash')
+fig.update_layout(title=f"Effects of every threshold for checkin type {checkin_type}", 
+                  xaxis_title='threshold (minutes)', yaxis_title='%')
+st.plotly_chart(fig, use_container_width=True)
 
 st.markdown("---")
 
@@ -133,102 +191,43 @@ st.markdown("""
 
 ## Question 2
 st.markdown("Question 2: How many rentals would be affected by the feature depending on the threshold and scope we choose?")
-if checkin_type == 'both':
-    delay_question2 = delay.copy()
-else:
-    delay_question2 = delay.loc[delay['checkin_type']==checkin_type, :].copy()
-delay_question2['threshold'] = delay_question2['time_delta_with_previous_rental_in_minutes']\
-    .apply(lambda x: 'below_threshold' if x<=threshold else 
-            'above_threshold')
-fig = px.pie(delay_question2['threshold'].value_counts(), values='count', 
-             names=delay_question2['threshold'].value_counts().index, 
-             color=delay_question2['threshold'].value_counts().index, 
+df_pie = pd.DataFrame({'count': [effects['rentals_below_threshold'], effects['rentals_above_threshold']]}, 
+                      index=['below_threshold', 'above_threshold'])
+fig = px.pie(df_pie, values='count', names=df_pie.index, color=df_pie.index, 
              color_discrete_map={'below_threshold': 'red', 'above_threshold': 'green'}, 
              title="Percentage of checkin_type rentals below or above the chosen threshold")
 st.plotly_chart(fig, use_container_width=True)
 
-value_metric_question2 = round(delay_question2['threshold'].value_counts()['below_threshold']/delay.shape[0]*100, ndigits=2)
+value_metric_question2 = round(effects['share_rentals_lost'], ndigits=2)
 st.metric(label="Percentage of all rentals potentially lost with your selected parameters", value=value_metric_question2)
 
 ## Question 3
 st.markdown("Question 3: How many problematic cases will it solve depending on the chosen threshold and scope?")
-if checkin_type == 'both':
-    delay_question3 = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['type_of_delay']=='late', :]
-else:
-    delay_question3 = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['type_of_delay']=='late', :]\
-    .loc[delay_prevRent_woNaN_previousdelay['checkin_type']==checkin_type, :]
+# Late arrivals below and above the chosen threshold, counted from the sorted time deltas
+delay_question3 = summary['late'].counts(threshold, where=None if checkin_type == 'both' else {'checkin_type': checkin_type})
 
 fig = px.histogram(delay_question3, 
-             'state', pattern_shape='checkin_type', color='threshold', text_auto=True,  
+             'state', y='count', pattern_shape='checkin_type', color='threshold', text_auto=True,  
              title='Impact of late arrivals on the next driver')
+fig.update_layout(yaxis_title='count')
 st.plotly_chart(fig, use_container_width=True)
 
-df_groupby = delay_question3.groupby(['state', 'threshold'], as_index=False).size()
-df = df_groupby.loc[df_groupby['state']=='canceled',:]
-number_solved = df.loc[df['threshold']=='below_threshold', 'size'].values[0]
-total_number = delay_question3.groupby('state').count().loc['canceled', 'threshold']
-value_metric_question3 = round(number_solved/total_number*100, ndigits=2)
+value_metric_question3 = round(effects['share_problems_solved'], ndigits=2)
 st.metric(label="Percentage of problematic cases potentially solved with your selected parameters", value=value_metric_question3)
 
 ## Question 4
 st.markdown("Question 4: Which share of our owner’s revenue would potentially be affected by the feature?")
-fig = px.histogram(pricing, 'rental_price_per_day', color='has_getaround_connect', 
-                   title="Current rental prices (dashed lines: mean per category)")
-fig.add_vline(x=np.mean(pricing.loc[pricing['has_getaround_connect']==False, 
-                                    'rental_price_per_day']), line_dash = 'dash', line_color = 'blue')
-fig.add_vline(x=np.mean(pricing.loc[pricing['has_getaround_connect']==True, 
-                                    'rental_price_per_day']), line_dash = 'dash', line_color = 'lightblue')
+fig = px.bar(summary['prices'], 'rental_price_per_day', y='count', color='has_getaround_connect', 
+             hover_data=['bin_start', 'bin_end'], title="Current rental prices (dashed lines: mean per category)")
+fig.update_layout(bargap=0)
+fig.add_vline(x=summary['mean_prices'][False], line_dash = 'dash', line_color = 'blue')
+fig.add_vline(x=summary['mean_prices'][True], line_dash = 'dash', line_color = 'lightblue')
 st.plotly_chart(fig, use_container_width=True)
 
-current_prices = sum(pricing['rental_price_per_day'])
-if checkin_type == 'both':
-    percentage_affected = 1 - delay_question2['threshold'].value_counts()['below_threshold']/delay.shape[0]
-    shape = pricing.shape[0]
-    to_be_sampled = int(round(percentage_affected*shape, 0))
-    pricing_affected = pricing.sample(to_be_sampled, random_state=10)
-    mean_price_woFeature = np.mean(pricing['rental_price_per_day'])
-    mean_price_withFeature = np.mean(pricing_affected['rental_price_per_day'])
-    price_affected = mean_price_woFeature - mean_price_withFeature
-    total_rentals = delay_prevRent_woNaN_previousdelay.shape[0]
-    total_late = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['threshold']=='below_threshold', :].shape[0]
-    rentals_affected = total_late / total_rentals
-    affected_prices = sum(pricing['rental_price_per_day'])* (1-rentals_affected)*(1-price_affected) + \
-                  sum(pricing['rental_price_per_day'])*rentals_affected 
-elif checkin_type == 'connect':
-    percentage_affected = 1 - delay_question2['threshold'].value_counts()['below_threshold']/delay_question2.shape[0]
-    shape = pricing.loc[pricing['has_getaround_connect']==True, :].shape[0]
-    to_be_sampled = int(round(percentage_affected*shape, 0))
-    pricing_affected = pricing.loc[pricing['has_getaround_connect']==True, :].sample(to_be_sampled, random_state=10)
-    mean_price_woFeature = np.mean(pricing.loc[pricing['has_getaround_connect']==True, 'rental_price_per_day'])
-    mean_price_withFeature = np.mean(pricing_affected['rental_price_per_day'])
-    price_affected = mean_price_woFeature - mean_price_withFeature
-    total_rentals = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['checkin_type']=='connect', :].shape[0]
-    total_late = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['threshold']=='below_threshold', :]\
-        .loc[delay_prevRent_woNaN_previousdelay['checkin_type']=='connect', :].shape[0]
-    rentals_affected = total_late / total_rentals
-    affected_prices = sum(pricing.loc[pricing['has_getaround_connect']==True, 'rental_price_per_day'])* \
-                  (1-rentals_affected)*(1-price_affected) + \
-                  sum(pricing.loc[pricing['has_getaround_connect']==True, 'rental_price_per_day'])*rentals_affected + \
-                  sum(pricing.loc[pricing['has_getaround_connect']==False, 'rental_price_per_day'])
-else:
-    percentage_affected = 1 - delay_question2['threshold'].value_counts()['below_threshold']/delay_question2.shape[0]
-    shape = pricing.loc[pricing['has_getaround_connect']==False, :].shape[0]
-    to_be_sampled = int(round(percentage_affected*shape, 0))
-    pricing_affected = pricing.loc[pricing['has_getaround_connect']==False, :].sample(to_be_sampled, random_state=10)
-    mean_price_woFeature = np.mean(pricing.loc[pricing['has_getaround_connect']==False, 'rental_price_per_day'])
-    mean_price_withFeature = np.mean(pricing_affected['rental_price_per_day'])
-    price_affected = mean_price_woFeature - mean_price_withFeature
-    total_rentals = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['checkin_type']=='mobile', :].shape[0]
-    total_late = delay_prevRent_woNaN_previousdelay.loc[delay_prevRent_woNaN_previousdelay['threshold']=='below_threshold', :]\
-        .loc[delay_prevRent_woNaN_previousdelay['checkin_type']=='mobile', :].shape[0]
-    rentals_affected = total_late / total_rentals
-    affected_prices = sum(pricing.loc[pricing['has_getaround_connect']==False, 'rental_price_per_day'])* \
-                  (1-rentals_affected)*(1-price_affected) + \
-                  sum(pricing.loc[pricing['has_getaround_connect']==False, 'rental_price_per_day'])*rentals_affected + \
-                  sum(pricing.loc[pricing['has_getaround_connect']==True, 'rental_price_per_day'])
-
-total_loss = current_prices - affected_prices
-percent_loss = (current_prices - affected_prices)/current_prices*100
+price_affected = effects['price_affected']
+rentals_affected = effects['rentals_affected']
+total_loss = effects['total_loss']
+percent_loss = effects['percent_loss']
 a, b = st.columns(2)
 c, d = st.columns(2)
 a.metric(label="perte de prix moyenne par jour (€)", value=round(price_affected, ndigits=2))
@@ -0,0 +1,149 @@
+import hashlib
+import json
+import os
+import shutil
+import urllib.request
+from dataclasses import dataclass, field
+
+import pandas as pd
+import pyarrow.feather as feather
+
+
+#### Datasets of the project, shared by the dashboard, train.py and test.py.
+#### Each source is fetched once and converted to an Arrow file with explicit types, which is
+#### memory-mapped on the next loads instead of parsing the Excel / CSV file again. A checksum of
+#### the source tells when the converted file is stale.
+####
+#### GETAROUND_DATA_CACHE: where the files are kept (~/.cache/getaround by default)
+#### GETAROUND_DATA_SOURCE: local directory holding the source files, to work offline
+
+CACHE_DIR = os.environ.get('GETAROUND_DATA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'getaround'))
+SOURCE_DIR = os.environ.get('GETAROUND_DATA_SOURCE')
+
+
+@dataclass
+class Source:
+    url: str
+    dtypes: dict = field(default_factory=dict)
+
+    @property
+    def filename(self):
+        return os.path.basename(self.url)
+
+    def read(self, path):
+        if path.endswith('.xlsx'):
+            raw = pd.read_excel(path)
+        else:
+            raw = pd.read_csv(path)
+        return raw.astype({col: dtype for col, dtype in self.dtypes.items() if col in raw.columns})
+
+
+SOURCES = {
+    'delay': Source(
+        'https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_delay_analysis.xlsx',
+        {'rental_id': 'int64', 'car_id': 'int64', 'checkin_type': 'category', 'state': 'category',
+         'delay_at_checkout_in_minutes': 'float64', 'previous_ended_rental_id': 'float64',
+         'time_delta_with_previous_rental_in_minutes': 'float64'}),
+    'pricing': Source(
+        'https://full-stack-assets.s3.eu-west-3.amazonaws.com/Deployment/get_around_pricing_project.csv',
+        {'model_key': 'category', 'mileage': 'int64', 'engine_power': 'int64', 'fuel': 'category',
+         'paint_color': 'category', 'car_type': 'category', 'private_parking_available': 'bool',
+         'has_gps': 'bool', 'has_air_conditioning': 'bool', 'automatic_car': 'bool',
+         'has_getaround_connect': 'bool', 'has_speed_regulator': 'bool', 'winter_tires': 'bool',
+         'rental_price_per_day': 'int64'}),
+}
+
+
+def sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def remote_etag(url, timeout=5):
+    """ETag of the remote file (a checksum of its content on S3), None when it can not be reached."""
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, method='HEAD'), timeout=timeout) as response:
+            return response.headers.get('ETag')
+    except OSError:
+        return None
+
+
+class DataStore:
+    """
+    Local copies of the SOURCES in `cache_dir`: for each dataset, the source file as downloaded,
+    its Arrow conversion (<name>.arrow) and a manifest (<name>.json) with the checksum of the
+    source it was converted from.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, source_dir=SOURCE_DIR, sources=SOURCES):
+        self.cache_dir = cache_dir
+        self.source_dir = source_dir
+        self.sources = sources
+
+    def _path(self, *names):
+        return os.path.join(self.cache_dir, *names)
+
+    def _manifest(self, name):
+        try:
+            with open(self._path(name + '.json')) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _fetch(self, source, manifest, refresh):
+        """Path of an up to date source file, and its ETag when it comes from the network."""
+        if self.source_dir:
+            return os.path.join(self.source_dir, source.filename), None
+        path = self._path('sources', source.filename)
+        etag = remote_etag(source.url)
+        # Without network, the copy already downloaded is used
+        stale = refresh or (etag is not None and etag != manifest.get('etag'))
+        if stale or not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with urllib.request.urlopen(source.url) as response, open(path + '.tmp', 'wb') as f:
+                shutil.copyfileobj(response, f)
+                etag = response.headers.get('ETag', etag)
+            os.replace(path + '.tmp', path)
+        return path, etag or manifest.get('etag')
+
+    def path(self, name, refresh=False):
+        """Arrow file of the dataset `name`, converted again when its source has changed."""
+        source = self.sources[name]
+        manifest = self._manifest(name)
+        source_path, etag = self._fetch(source, manifest, refresh)
+        # The checksum is only computed again when the file was modified since the conversion
+        stat = os.stat(source_path)
+        if [stat.st_size, stat.st_mtime] == manifest.get('stat'):
+            checksum = manifest['sha256']
+        else:
+            checksum = sha256(source_path)
+        arrow_path = self._path(name + '.arrow')
+        if checksum != manifest.get('sha256') or not os.path.exists(arrow_path):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Uncompressed, so that the file can be memory-mapped without decoding it
+            feather.write_feather(source.read(source_path), arrow_path + '.tmp', compression='uncompressed')
+            os.replace(arrow_path + '.tmp', arrow_path)
+        if checksum != manifest.get('sha256') or [stat.st_size, stat.st_mtime] != manifest.get('stat'):
+            with open(self._path(name + '.json'), 'w') as f:
+                json.dump({'source': source.url, 'sha256': checksum, 'stat': [stat.st_size, stat.st_mtime],
+                           'etag': etag, 'dtypes': source.dtypes}, f)
+        return arrow_path
+
+    def load(self, name, columns=None, categorical=True, refresh=False):
+        """
+        DataFrame of the dataset `name` ('delay' or 'pricing'). With `categorical=False`, the
+        categorical columns are returned as strings, as read from the source file.
+        """
+        table = feather.read_table(self.path(name, refresh), columns=columns, memory_map=True)
+        data = table.to_pandas()
+        if not categorical:
+            data = data.astype({col: object for col in data.columns if isinstance(data[col].dtype, pd.CategoricalDtype)})
+        return data
+
+
+def load(name, columns=None, categorical=True, refresh=False):
+    """Dataset `name` from the default store, see DataStore.load."""
+    return DataStore().load(name, columns, categorical, refresh)
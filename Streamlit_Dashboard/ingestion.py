@@ -0,0 +1,268 @@
+import argparse
+import glob
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from datastore import SOURCES
+from rentals import rental_chains, delayed_chains
+from thresholds import THRESHOLDS, ThresholdSweep, CHECKIN_TYPES
+
+
+#### Incremental ingestion of the rental log: new rentals are appended by chunks to a Parquet
+#### store, and the rental chains and threshold aggregates of the dashboard are updated with the
+#### new rentals only, instead of being computed again from the whole history.
+####   python ingestion.py --store rentals_store new_rentals.csv [...]
+
+DELAY_DTYPES = SOURCES['delay'].dtypes
+CHAIN_KEYS = ('rentals', 'chains', 'problems')
+
+
+def concat(*frames):
+    """Concatenation of the frames that are not None nor empty (None if there is none)."""
+    frames = [frame for frame in frames if frame is not None]
+    filled = [frame for frame in frames if not frame.empty]
+    if not filled:
+        return frames[0].copy() if frames else None
+    return pd.concat(filled, ignore_index=True)
+
+
+class DeltaHistogram:
+    """
+    Number of rentals per time delta with the previous rental, rounded up to the minute: the
+    counts below any whole threshold of THRESHOLDS are its cumulative sums. Rentals without
+    previous rental are only counted in `size`. Can be updated, unlike thresholds.SortedDeltas.
+    """
+
+    def __init__(self, counts=None, size=0):
+        self.counts = np.zeros(THRESHOLDS[-1] + 2, dtype=np.int64) if counts is None else np.asarray(counts)
+        self.size = int(size)
+
+    def add(self, rentals):
+        deltas = rentals['time_delta_with_previous_rental_in_minutes'].to_numpy(dtype=float)
+        deltas = deltas[~np.isnan(deltas)]
+        # Last bin: deltas above the last threshold
+        bins = np.clip(np.ceil(deltas), 0, self.counts.shape[0] - 1).astype(np.int64)
+        self.counts += np.bincount(bins, minlength=self.counts.shape[0])
+        self.size += rentals.shape[0]
+
+    def below(self, thresholds):
+        return np.cumsum(self.counts)[np.asarray(thresholds)]
+
+    def __add__(self, other):
+        return DeltaHistogram(self.counts + other.counts, self.size + other.size)
+
+    def copy(self):
+        return DeltaHistogram(self.counts.copy(), self.size)
+
+
+class RentalStore:
+    """
+    Rental log in `directory`, the files of the N-th ingested chunk being named part-N:
+
+    - rentals/part-*.parquet: the rentals, one file per ingested chunk
+    - chains/part-*.parquet: the rental chains (rentals.rental_chains) found in each chunk. A chain
+      whose previous rental was not ingested yet is written again, completed, once it arrives:
+      the last version of each chain wins
+    - waiting/part-*.parquet: the chains whose previous rental is not stored yet, after each chunk
+    - aggregates/part-*.json: per type of checkin, the DeltaHistogram of the rentals, of the chains
+      with a known previous delay and of the cancellations after a late previous driver, after each chunk
+
+    The rentals of a chunk are written last and commit it: the files of a chunk interrupted before
+    are ignored, and overwritten when it is ingested again. Only the waiting chains and aggregates
+    of the last committed chunk are kept.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._aggregates = None
+
+    def _path(self, *names):
+        return os.path.join(self.directory, *names)
+
+    def _part_path(self, table, number, extension='parquet'):
+        return self._path(table, f'part-{number:06d}.{extension}')
+
+    def _parts(self, table):
+        """Files of `table` of the committed chunks, in order."""
+        parts = sorted(glob.glob(self._path(table, 'part-*.parquet')))
+        if table == 'rentals':
+            return parts
+        version = self.version
+        return [part for part in parts if int(os.path.basename(part)[5:11]) <= version]
+
+    def _read(self, table, columns=None, filter=None):
+        parts = self._parts(table)
+        if not parts:
+            return None
+        return ds.dataset(parts, format='parquet').to_table(columns=columns, filter=filter).to_pandas()
+
+    def _write(self, table, data, number):
+        os.makedirs(self._path(table), exist_ok=True)
+        path = self._part_path(table, number)
+        pq.write_table(pa.Table.from_pandas(data, preserve_index=False), path + '.tmp')
+        os.replace(path + '.tmp', path)
+
+    def _remove_before(self, table, number, extension='parquet'):
+        """Files of `table` of the chunks before `number`, replaced by the one of chunk `number`."""
+        for part in glob.glob(self._path(table, f'part-*.{extension}')):
+            if int(os.path.basename(part)[5:11]) < number:
+                os.remove(part)
+
+    @property
+    def aggregates(self):
+        """Aggregates of the last committed chunk, keyed by (checkin type, one of CHAIN_KEYS)."""
+        version = self.version
+        if self._aggregates is None or self._aggregates[0] != version:
+            try:
+                with open(self._part_path('aggregates', version, 'json')) as f:
+                    saved = json.load(f)
+            except OSError:
+                saved = {}
+            self._aggregates = (version, {
+                (checkin_type, key): DeltaHistogram(**saved[f'{checkin_type}/{key}'])
+                if f'{checkin_type}/{key}' in saved else DeltaHistogram()
+                for checkin_type in CHECKIN_TYPES if checkin_type != 'both' for key in CHAIN_KEYS})
+        return self._aggregates[1]
+
+    def _save_aggregates(self, aggregates, number):
+        saved = {f'{checkin_type}/{key}': {'counts': histogram.counts.tolist(), 'size': histogram.size}
+                 for (checkin_type, key), histogram in aggregates.items()}
+        os.makedirs(self._path('aggregates'), exist_ok=True)
+        path = self._part_path('aggregates', number, 'json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(saved, f)
+        os.replace(path + '.tmp', path)
+
+    def _read_waiting(self):
+        try:
+            return pd.read_parquet(self._part_path('waiting', self.version))
+        except OSError:
+            return None
+
+    def append(self, rentals):
+        """Add a chunk of new rentals (columns of the delay analysis), rentals already stored are skipped."""
+        rentals = rentals.astype({col: dtype for col, dtype in DELAY_DTYPES.items() if col in rentals.columns})
+        stored = self._read('rentals', columns=['rental_id'])
+        if stored is not None:
+            rentals = rentals.loc[~rentals['rental_id'].isin(stored['rental_id']), :]
+        rentals = rentals.drop_duplicates('rental_id')
+        if rentals.empty:
+            return 0
+        number = self.version + 1
+
+        # Chains of the new rentals, previous rentals looked up among the stored and new rentals
+        previous_ids = rentals['previous_ended_rental_id'].dropna().astype('int64').unique()
+        previous = self._read('rentals', columns=['rental_id', 'delay_at_checkout_in_minutes'],
+                              filter=ds.field('rental_id').isin(pa.array(previous_ids)))
+        known = concat(previous, rentals)
+        chains = rental_chains(rentals, previous=known)
+        found = chains['previous_ended_rental_id'].isin(known['rental_id'])
+
+        # Chains stored before their previous rental, completed by this chunk
+        waiting = concat(self._read_waiting(), chains.loc[~found, :])
+        arrived = waiting['previous_ended_rental_id'].isin(rentals['rental_id'])
+        completed = rental_chains(waiting.loc[arrived, :], previous=rentals)
+        chains = concat(chains.loc[found, :], completed)
+        chains['part'] = number
+
+        # Updated on copies: the aggregates of the last committed chunk are left as they are
+        aggregates = {key: histogram.copy() for key, histogram in self.aggregates.items()}
+        for checkin_type, group in rentals.groupby('checkin_type', observed=True):
+            aggregates[(checkin_type, 'rentals')].add(group)
+        for checkin_type, group in delayed_chains(chains).groupby('checkin_type', observed=True):
+            aggregates[(checkin_type, 'chains')].add(group)
+            problems = group.loc[(group['type_of_delay'] == 'late') & (group['state'] == 'canceled'), :]
+            aggregates[(checkin_type, 'problems')].add(problems)
+
+        self._write('chains', chains, number)
+        self._write('waiting', waiting.loc[~arrived, :], number)
+        self._save_aggregates(aggregates, number)
+        # The rentals are written last and commit the chunk: until then, the store is read as before it
+        self._write('rentals', rentals, number)
+        self._remove_before('waiting', number)
+        self._remove_before('aggregates', number, 'json')
+        return rentals.shape[0]
+
+    def ingest(self, path, chunksize=100000):
+        """Append the rentals of a CSV, Parquet or Excel file by chunks of `chunksize` rows."""
+        if path.endswith('.csv'):
+            chunks = pd.read_csv(path, chunksize=chunksize)
+        elif path.endswith('.parquet'):
+            chunks = (batch.to_pandas() for batch in pq.ParquetFile(path).iter_batches(chunksize))
+        else:
+            rentals = pd.read_excel(path)
+            chunks = (rentals.iloc[start:start+chunksize] for start in range(0, rentals.shape[0], chunksize))
+        return sum(self.append(chunk) for chunk in chunks)
+
+    @property
+    def version(self):
+        """Number of chunks ingested so far."""
+        return len(self._parts('rentals'))
+
+    def rentals(self, columns=None):
+        """All the stored rentals, like the delay analysis."""
+        rentals = self._read('rentals', columns=columns)
+        if rentals is None:
+            return None
+        return rentals.astype({col: dtype for col, dtype in DELAY_DTYPES.items() if col in rentals.columns})
+
+    @property
+    def size(self):
+        """Number of stored rentals, from the metadata of the files."""
+        return sum(pq.ParquetFile(part).metadata.num_rows for part in self._parts('rentals'))
+
+    def rentals_page(self, number, size):
+        """Rentals of the page `number` (from 1) of `size` rentals: only the files holding them are read."""
+        start, frames, offset = (number - 1) * size, [], 0
+        for part in self._parts('rentals'):
+            rows = pq.ParquetFile(part).metadata.num_rows
+            if offset < start + size and offset + rows > start:
+                frames.append(pd.read_parquet(part).iloc[max(0, start - offset):start + size - offset])
+            offset += rows
+        rentals = concat(*frames)
+        if rentals is None:
+            return None
+        return rentals.astype({col: dtype for col, dtype in DELAY_DTYPES.items() if col in rentals.columns})
+
+    def chains(self):
+        """
+        Rental chains, like rentals.rental_chains on all the stored rentals. Chains whose previous
+        rental is not stored yet have no previous delay, and are in waiting.parquet.
+        """
+        waiting = self._read_waiting()
+        stored = concat(self._read('chains'), None if waiting is None else waiting.assign(part=0))
+        if stored is None:
+            return None
+        chains = stored.sort_values('part', kind='stable').drop_duplicates('rental_id', keep='last')
+        chains = chains.drop(columns='part').sort_values('rental_id').reset_index(drop=True)
+        return chains.astype({col: dtype for col, dtype in DELAY_DTYPES.items() if col in chains.columns})
+
+    def sweeps(self, pricing, thresholds=THRESHOLDS):
+        """thresholds.threshold_sweeps of the stored rentals, from the aggregates only."""
+        aggregates = self.aggregates
+        total_rentals = sum(aggregates[(checkin_type, 'rentals')].size
+                            for checkin_type in CHECKIN_TYPES if checkin_type != 'both')
+        sweeps = {}
+        for checkin_type in CHECKIN_TYPES:
+            types = [checkin_type] if checkin_type != 'both' else [t for t in CHECKIN_TYPES if t != 'both']
+            counts = [sum((aggregates[(t, key)] for t in types), DeltaHistogram()) for key in CHAIN_KEYS]
+            sweep = ThresholdSweep(*counts, total_rentals, pricing, checkin_type)
+            sweeps[checkin_type] = sweep.sweep(thresholds)
+        return sweeps
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--store", required=True, help="directory of the rental store")
+    parser.add_argument("--chunksize", type=int, default=100000)
+    parser.add_argument("files", nargs="+", help="CSV, Parquet or Excel files of new rentals")
+    args = parser.parse_args()
+    store = RentalStore(args.store)
+    for path in args.files:
+        print(f"{path}: {store.ingest(path, args.chunksize)} new rentals")
@@ -0,0 +1,34 @@
+import numpy as np
+import pandas as pd
+
+
+#### Rental chains of the delay analysis: rentals following another rental of the same car.
+#### Plain pandas, so that they can be built outside of the dashboard (notebooks, scripts).
+
+def rental_chains(delay, previous=None):
+    """
+    Rentals with a previous rental, and the delay at checkout of that previous rental
+    (NaN when it is not in `previous`, `delay` by default, or was not recorded).
+
+    The previous rentals are looked up in an index of `previous` on rental_id: one hash join
+    instead of a scan of `previous` per rental.
+    """
+    previous = delay if previous is None else previous
+    chains = delay[pd.notna(delay['previous_ended_rental_id'])].copy().reset_index(drop=True)
+    chains['previous_ended_rental_id'] = chains['previous_ended_rental_id'].astype(int)
+    delay_at_checkout = previous.drop_duplicates('rental_id').set_index('rental_id')['delay_at_checkout_in_minutes']
+    chains['previous_delay_at_checkout'] = chains['previous_ended_rental_id'].map(delay_at_checkout)
+    return chains
+
+
+def delayed_chains(chains):
+    """
+    Rental chains where the delay at checkout of the previous rental is known, with:
+    - timedelta_minus_delay: time left between the two rentals once the previous driver is back
+    - type_of_delay: 'late' or 'in_advance' previous driver
+    """
+    delayed = chains[pd.notna(chains['previous_delay_at_checkout'])].copy().reset_index(drop=True)
+    delayed['timedelta_minus_delay'] = delayed['time_delta_with_previous_rental_in_minutes'] \
+                                       - delayed['previous_delay_at_checkout']
+    delayed['type_of_delay'] = np.where(delayed['previous_delay_at_checkout'] <= 0, 'in_advance', 'late')
+    return delayed
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+
+#### Effects of a minimum delay between two rentals, for every threshold at once.
+#### The threshold only compares with time_delta_with_previous_rental_in_minutes: once these
+#### deltas are sorted, the rentals below any threshold are counted with a binary search.
+
+THRESHOLDS = np.arange(0, 720)
+CHECKIN_TYPES = ('connect', 'mobile', 'both')
+
+
+class SortedDeltas:
+    """Time deltas with the previous rental of some rentals, sorted (rentals without previous rental left out)."""
+
+    def __init__(self, rentals):
+        deltas = rentals['time_delta_with_previous_rental_in_minutes'].to_numpy(dtype=float)
+        self.deltas = np.sort(deltas[~np.isnan(deltas)])
+        self.size = rentals.shape[0]
+
+    def below(self, thresholds):
+        """Number of rentals with a time delta <= each threshold."""
+        return np.searchsorted(self.deltas, thresholds, side='right')
+
+
+class ThresholdSweep:
+    """
+    Metrics of the dashboard for one type of checkin ('connect', 'mobile' or 'both'):
+
+    - share of all rentals potentially lost (rentals of the scope below the threshold)
+    - share of the cancellations after a late previous driver that would be avoided
+    - loss of revenue of the owners
+
+    `rentals`, `chains` and `problems` count the rentals of the scope, its rental chains with a
+    known previous delay and the cancellations after a late previous driver: objects with a
+    `size` and a `below(thresholds)` method, like SortedDeltas. `total_rentals` is the number of
+    rentals of all types and `pricing` the pricing dataset. The counts are built once; `sweep`
+    then answers for any number of thresholds without going over the rows.
+    """
+
+    def __init__(self, rentals, chains, problems, total_rentals, pricing, checkin_type='both'):
+        if checkin_type not in CHECKIN_TYPES:
+            raise ValueError(f"Unknown checkin type {checkin_type!r}, expected one of {CHECKIN_TYPES}")
+        self.checkin_type = checkin_type
+        self.total_rentals = total_rentals
+        self.rentals, self.rentals_in_scope = rentals, rentals.size
+        self.chains, self.chains_in_scope = chains, chains.size
+        self.problems, self.problems_in_scope = problems, problems.size
+        self._set_prices(pricing)
+
+    @classmethod
+    def from_frames(cls, delay, chains, pricing, checkin_type='both'):
+        """
+        Sweep of the delay analysis `delay`, its rental chains with a known previous delay
+        (rentals.delayed_chains) and the pricing dataset.
+        """
+        total_rentals = delay.shape[0]
+        if checkin_type != 'both':
+            delay = delay.loc[delay['checkin_type'] == checkin_type, :]
+            chains = chains.loc[chains['checkin_type'] == checkin_type, :]
+        problems = chains.loc[(chains['type_of_delay'] == 'late') & (chains['state'] == 'canceled'), :]
+        return cls(SortedDeltas(delay), SortedDeltas(chains), SortedDeltas(problems), total_rentals, pricing,
+                   checkin_type)
+
+    def _set_prices(self, pricing):
+        checkin_type = self.checkin_type
+        # Cars of the scope: with Getaround Connect for 'connect', without for 'mobile'
+        if checkin_type == 'both':
+            in_scope = np.ones(pricing.shape[0], dtype=bool)
+        else:
+            in_scope = (pricing['has_getaround_connect'] == (checkin_type == 'connect')).to_numpy()
+        prices = pricing['rental_price_per_day'].to_numpy(dtype=float)
+        self.revenue = prices.sum()
+        self.revenue_in_scope = prices[in_scope].sum()
+        self.mean_price_in_scope = prices[in_scope].mean()
+        # pricing.sample(n, random_state=10) draws the first n cars of this permutation:
+        # the mean price of every sample size is a cumulative mean
+        scope_prices = prices[in_scope]
+        order = np.random.RandomState(10).permutation(scope_prices.shape[0])
+        self.sampled_sums = np.concatenate([[0.0], np.cumsum(scope_prices[order])])
+
+    def sweep(self, thresholds=THRESHOLDS):
+        """DataFrame of the metrics for each threshold (in minutes), indexed by threshold."""
+        thresholds = np.asarray(thresholds)
+        rentals_below = self.rentals.below(thresholds)
+        chains_below = self.chains.below(thresholds)
+        problems_solved = self.problems.below(thresholds)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Question 4: the cars kept by the owners are as many as the rentals above the threshold
+            percentage_kept = 1 - rentals_below / self.rentals_in_scope
+            sampled = np.round(percentage_kept * (self.sampled_sums.shape[0] - 1), 0).astype(int)
+            price_affected = self.mean_price_in_scope - self.sampled_sums[sampled] / sampled
+            rentals_affected = chains_below / self.chains_in_scope
+            affected_prices = self.revenue_in_scope * (1 - rentals_affected) * (1 - price_affected) \
+                              + self.revenue_in_scope * rentals_affected \
+                              + (self.revenue - self.revenue_in_scope)
+
+            return pd.DataFrame({
+                'rentals_below_threshold': rentals_below,
+                'rentals_above_threshold': self.rentals_in_scope - rentals_below,
+                'share_rentals_lost': rentals_below / self.total_rentals * 100,
+                'problems_solved': problems_solved,
+                'problems_total': self.problems_in_scope,
+                'share_problems_solved': problems_solved / self.problems_in_scope * 100,
+                'price_affected': price_affected,
+                'rentals_affected': rentals_affected,
+                'total_loss': self.revenue - affected_prices,
+                'percent_loss': (self.revenue - affected_prices) / self.revenue * 100,
+            }, index=pd.Index(thresholds, name='threshold'))
+
+
+def threshold_sweeps(delay, chains, pricing, thresholds=THRESHOLDS):
+    """Sweep of each type of checkin, keyed by type."""
+    return {checkin_type: ThresholdSweep.from_frames(delay, chains, pricing, checkin_type).sweep(thresholds)
+            for checkin_type in CHECKIN_TYPES}